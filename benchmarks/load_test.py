@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""
+Load test cho /search, /search/batch, /apartments và /chat với dịch vụ ngoài giả lập
+
+App FastAPI chạy trong cùng process (qua httpx.ASGITransport, có lifespan).
+Cloudinary và OpenAI được thay bằng một server HTTP local (uvicorn, cổng ngẫu
+nhiên) nối vào qua CLOUDINARY_UPLOAD_URL / OPENAI_BASE_URL, có thể cấu hình độ
+trễ và tỉ lệ lỗi. Cache upload / câu trả lời AI được đặt trong thư mục tạm nên
+mỗi lần chạy bắt đầu từ cache rỗng.
+
+Bộ query lấy từ benchmarks/queries.jsonl (mỗi dòng: endpoint, method, path,
+params/json, weight, expect) cộng các câu hỏi ví dụ trong chat_ui.py (cho /chat
+và /chat/stream). Mỗi endpoint được chạy thành một pha riêng, cuối cùng là pha
+"mixed" trộn tất cả theo weight. Báo cáo p50/p95/p99 latency, throughput,
+số lỗi và RSS sau mỗi pha.
+
+Chạy:
+    python benchmarks/load_test.py                          # in kết quả
+    python benchmarks/load_test.py --requests 500 --concurrency 32
+    python benchmarks/load_test.py --openai-latency 0.8 --upload-failure-rate 0.1
+    python benchmarks/load_test.py --save baseline.json     # lưu baseline
+    python benchmarks/load_test.py --baseline baseline.json --tolerance 0.2
+        # exit 1 nếu p95 hoặc throughput tệ hơn baseline quá 20%
+"""
+
+import argparse
+import ast
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = os.path.join(ROOT, "benchmarks", "queries.jsonl")
+
+STUB_IMAGE_URL = "https://res.cloudinary.test/apartment/{public_id}.jpg"
+STUB_ANSWER = "Căn hộ này có vị trí đẹp, thiết kế hợp lý và mức giá cạnh tranh so với khu vực."
+
+
+def create_stub_app(args):
+    """Server giả lập Cloudinary (POST /upload) và OpenAI (POST /v1/chat/completions)"""
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse, StreamingResponse
+
+    stub = FastAPI()
+    rng = random.Random(args.seed)
+
+    @stub.post("/upload")
+    async def upload(request: Request):
+        # Lấy public_id từ body multipart (không cần python-multipart)
+        body = await request.body()
+        match = re.search(rb'name="public_id"\r\n\r\n([^\r]*)', body)
+        public_id = match.group(1).decode() if match else "x"
+        await asyncio.sleep(args.upload_latency)
+        if rng.random() < args.upload_failure_rate:
+            return JSONResponse({"error": {"message": "injected failure"}}, status_code=500)
+        return {"secure_url": STUB_IMAGE_URL.format(public_id=public_id)}
+
+    @stub.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await asyncio.sleep(args.openai_latency)
+        if rng.random() < args.openai_failure_rate:
+            return JSONResponse({"error": {"message": "injected failure", "type": "server_error"}}, status_code=500)
+
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": body.get("model", "gpt-4o")}
+        if not body.get("stream"):
+            return {
+                **base,
+                "object": "chat.completion",
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": STUB_ANSWER}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+            }
+
+        async def stream():
+            for word in STUB_ANSWER.split(" "):
+                await asyncio.sleep(args.openai_token_delay)
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return stub
+
+
+def start_stub_server(args) -> str:
+    """Chạy stub server trong thread nền, trả về base URL"""
+    import socket
+    import uvicorn
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(create_stub_app(args), host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, name="stub-server", daemon=True).start()
+    deadline = time.monotonic() + 10
+    while not server.started:
+        if time.monotonic() > deadline:
+            sys.exit("Stub server không khởi động được")
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{port}"
+
+
+def load_mix(path: str, chat_examples: bool = True) -> list:
+    """Đọc query mix từ file jsonl, thêm các câu hỏi ví dụ của chat_ui.py"""
+    with open(path, encoding="utf-8") as f:
+        mix = [json.loads(line) for line in f if line.strip()]
+    if chat_examples:
+        for query in chat_ui_examples():
+            mix.append({"endpoint": "chat", "method": "POST", "path": "/chat", "json": {"query": query}, "weight": 1})
+            mix.append({"endpoint": "chat_stream", "method": "POST", "path": "/chat/stream", "json": {"query": query}, "weight": 1})
+    return mix
+
+
+def chat_ui_examples() -> list:
+    """Lấy example_queries trong chat_ui.py mà không import streamlit"""
+    with open(os.path.join(ROOT, "chat_ui.py"), encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign) and any(
+            isinstance(target, ast.Name) and target.id == "example_queries" for target in node.targets
+        ):
+            return ast.literal_eval(node.value)
+    return []
+
+
+def rss_mb() -> float:
+    """RSS hiện tại (MB), fallback sang peak RSS nếu không có /proc"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def is_failure(entry: dict, response) -> bool:
+    """Lỗi = status khác expect, hoặc /chat trả success=False, hoặc /chat/stream có event error"""
+    if response.status_code != entry.get("expect", 200):
+        return True
+    if entry["path"] == "/chat":
+        return not response.json().get("success")
+    if entry["path"] == "/chat/stream":
+        return "event: error" in response.text or '"error"' in response.text
+    return False
+
+
+async def run_phase(client, entries: list, total: int, concurrency: int, rng: random.Random) -> dict:
+    """Gửi `total` request chọn theo weight từ entries, tối đa `concurrency` request song song"""
+    plan = rng.choices(entries, weights=[e.get("weight", 1) for e in entries], k=total)
+    latencies = []
+    failures = 0
+    statuses = {}
+
+    async def worker(queue):
+        nonlocal failures
+        while queue:
+            entry = queue.pop()
+            start = time.perf_counter()
+            try:
+                response = await client.request(
+                    entry["method"], entry["path"], params=entry.get("params"), json=entry.get("json")
+                )
+                failed = is_failure(entry, response)
+                status = response.status_code
+            except Exception:
+                failed = True
+                status = "exception"
+            latencies.append(time.perf_counter() - start)
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+            failures += failed
+
+    queue = list(reversed(plan))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(queue) for _ in range(min(concurrency, total))))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": total,
+        "failures": failures,
+        "statuses": statuses,
+        "throughput_rps": total / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "rss_mb": rss_mb()
+    }
+
+
+async def run_benchmark(args, mix: list) -> dict:
+    import httpx
+    import main
+
+    phases = {}
+    for entry in mix:
+        phases.setdefault(entry["endpoint"], []).append(entry)
+    if args.endpoints:
+        phases = {name: entries for name, entries in phases.items() if name in args.endpoints}
+    phases["mixed"] = [entry for entries in phases.values() for entry in entries]
+
+    rng = random.Random(args.seed)
+    results = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://app", timeout=args.timeout) as client:
+            # Load data trước để pha đầu tiên không gánh thời gian load_data
+            await asyncio.to_thread(main.get_searcher)
+            baseline_rss = rss_mb()
+            for name, entries in phases.items():
+                rss_before = rss_mb()
+                result = await run_phase(client, entries, args.requests, args.concurrency, rng)
+                result["rss_delta_mb"] = result["rss_mb"] - rss_before
+                results[name] = result
+                print_result(name, result)
+
+    return {
+        "config": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "upload_latency": args.upload_latency,
+            "upload_failure_rate": args.upload_failure_rate,
+            "openai_latency": args.openai_latency,
+            "openai_token_delay": args.openai_token_delay,
+            "openai_failure_rate": args.openai_failure_rate,
+            "render_executor": main.render_executor.kind
+        },
+        "baseline_rss_mb": baseline_rss,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "endpoints": results
+    }
+
+
+def print_result(name: str, result: dict):
+    print(f"   {name:>16}: {result['throughput_rps']:7.1f} req/s  "
+          f"p50 {result['p50_ms']:7.1f} ms  p95 {result['p95_ms']:7.1f} ms  p99 {result['p99_ms']:7.1f} ms  "
+          f"lỗi {result['failures']:>4}/{result['requests']}  RSS {result['rss_mb']:6.1f} MB "
+          f"({result['rss_delta_mb']:+.1f})")
+
+
+def compare_with_baseline(report: dict, baseline: dict, tolerance: float) -> list:
+    """So sánh p95 (thấp hơn là tốt) và throughput (cao hơn là tốt) theo từng endpoint"""
+    regressions = []
+    for name, result in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(name)
+        if previous is None:
+            continue
+        p95_ratio = result["p95_ms"] / previous["p95_ms"] if previous["p95_ms"] else 1.0
+        rps_ratio = previous["throughput_rps"] / result["throughput_rps"] if result["throughput_rps"] else float("inf")
+        regressed = p95_ratio > 1 + tolerance or rps_ratio > 1 + tolerance
+        status = "❌" if regressed else "✅"
+        print(f"   {status} {name}: p95 {previous['p95_ms']:.1f} -> {result['p95_ms']:.1f} ms ({p95_ratio:.2f}x), "
+              f"{previous['throughput_rps']:.1f} -> {result['throughput_rps']:.1f} req/s")
+        if regressed:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="File jsonl chứa query mix")
+    parser.add_argument("--no-chat-examples", action="store_true", help="Không thêm câu hỏi ví dụ từ chat_ui.py")
+    parser.add_argument("--endpoints", nargs="*", help="Chỉ chạy các endpoint này (theo trường endpoint trong mix)")
+    parser.add_argument("--requests", type=int, default=200, help="Số request mỗi pha")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--upload-latency", type=float, default=0.05, help="Độ trễ upload Cloudinary giả lập (giây)")
+    parser.add_argument("--upload-failure-rate", type=float, default=0.0)
+    parser.add_argument("--openai-latency", type=float, default=0.3, help="Độ trễ tới token đầu tiên của OpenAI giả lập (giây)")
+    parser.add_argument("--openai-token-delay", type=float, default=0.01, help="Độ trễ giữa các token khi stream (giây)")
+    parser.add_argument("--openai-failure-rate", type=float, default=0.0)
+    parser.add_argument("--save", help="Ghi kết quả ra file JSON làm baseline")
+    parser.add_argument("--baseline", help="So sánh với baseline JSON, exit 1 nếu regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Ngưỡng tệ hơn cho phép (0.2 = 20%%)")
+    args = parser.parse_args()
+
+    stub_url = start_stub_server(args)
+    cache_dir = tempfile.mkdtemp(prefix="apartment-bench-")
+    # Phải set trước khi import main (các biến được đọc lúc import)
+    os.environ.update({
+        "CLOUDINARY_UPLOAD_URL": f"{stub_url}/upload",
+        "OPENAI_BASE_URL": f"{stub_url}/v1",
+        "OPENAI_API_KEY": "benchmark",
+        "UPLOAD_CACHE_PATH": os.path.join(cache_dir, "upload_cache.sqlite3"),
+        "LLM_CACHE_PATH": os.path.join(cache_dir, "answer_cache.sqlite3"),
+        "LOCAL_IMAGE_DIR": os.path.join(cache_dir, "images"),
+        "DATA_WATCH_INTERVAL": "0"
+    })
+    sys.path.insert(0, ROOT)
+
+    mix = load_mix(args.mix, chat_examples=not args.no_chat_examples)
+    print(f"📊 Load test: {args.requests} request/pha, concurrency {args.concurrency}, "
+          f"{len(mix)} query trong mix (stub: {stub_url})")
+    report = asyncio.run(run_benchmark(args, mix))
+    print(f"   RSS sau khi load data: {report['baseline_rss_mb']:.1f} MB, peak: {report['peak_rss_mb']:.1f} MB")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Đã lưu baseline: {args.save}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f"Regression: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: blend marker trên toàn bộ crop ("full") so với chỉ vùng marker ("roi")
+
+Chạy:
+    python benchmarks/render_marker.py
+    python benchmarks/render_marker.py --layer map --repeat 50 --zoom-sizes 100,500,3000
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+
+from main import get_searcher  # noqa: E402
+
+DEFAULT_ZOOM_SIZES = [100, 250, 500, 1000, 2000, 3000]
+
+
+def measure(render, repeat: int):
+    """Trả về (median ms, peak bytes cấp phát trong một lần render)"""
+    render()  # warm-up
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        render()
+        timings.append((time.perf_counter() - start) * 1000)
+    
+    tracemalloc.start()
+    render()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return statistics.median(timings), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--layer", choices=["blueprint", "map"], default="blueprint")
+    parser.add_argument("--apartment", default="CH01")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--zoom-sizes", default=",".join(str(z) for z in DEFAULT_ZOOM_SIZES))
+    args = parser.parse_args()
+    
+    searcher = get_searcher()
+    blueprint_coords, map_coords = searcher.get_apartment_coords(args.apartment)
+    coords = blueprint_coords if args.layer == "blueprint" else map_coords
+    if coords is None:
+        sys.exit(f"❌ Không có tọa độ {args.layer} cho căn {args.apartment}")
+    image = searcher.blueprint_image if args.layer == "blueprint" else searcher.map_image
+    zoom_sizes = [int(z) for z in args.zoom_sizes.split(",")]
+    
+    print(f"📊 {args.layer} {args.apartment} {coords}, {args.repeat} lần/mỗi cấu hình\n")
+    print(f"{'zoom':>6} | {'full ms':>9} {'full MB':>8} | {'roi ms':>9} {'roi MB':>8} | {'speedup':>7}")
+    print("-" * 66)
+    for zoom_size in zoom_sizes:
+        results = {}
+        for label, kwargs in (("full", {"blend_mode": "full"}),
+                              ("roi", {"blend_mode": "roi"})):
+            results[label] = measure(
+                lambda: searcher.create_zoomed_image_with_marker(
+                    image, coords, zoom_size, image_type=args.layer, **kwargs
+                ),
+                args.repeat
+            )
+        
+        # Hai chế độ phải cho ra ảnh giống hệt nhau
+        full = searcher.create_zoomed_image_with_marker(image, coords, zoom_size, image_type=args.layer, blend_mode="full")
+        roi = searcher.create_zoomed_image_with_marker(image, coords, zoom_size, image_type=args.layer, blend_mode="roi")
+        identical = "" if np.array_equal(full, roi) else "  ⚠️ output khác nhau"
+        
+        mb = 1024 * 1024
+        print(f"{zoom_size:>6} | {results['full'][0]:>9.3f} {results['full'][1] / mb:>8.2f} | "
+              f"{results['roi'][0]:>9.3f} {results['roi'][1] / mb:>8.2f} | "
+              f"{results['full'][0] / results['roi'][0]:>6.1f}x{identical}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Benchmark thời gian khởi động của main.py
+
+Đo trong process con mới (giống worker gunicorn / container vừa spawn):
+- import_s: thời gian `import main`
+- ready_s: import + lifespan startup + request đầu tiên tới / (worker sẵn sàng)
+- first_data_s: như ready_s + request /apartments đầu tiên (đã load CSV + ảnh)
+
+Chạy:
+    python benchmarks/startup.py                      # in kết quả
+    python benchmarks/startup.py --save baseline.json # lưu baseline
+    python benchmarks/startup.py --baseline baseline.json --tolerance 0.2
+        # exit 1 nếu chậm hơn baseline quá 20%
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = r"""
+import json, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    client.get("/")
+    ready = time.perf_counter()
+    client.get("/apartments")
+    first_data = time.perf_counter()
+print(json.dumps({
+    "import_s": imported - start,
+    "ready_s": ready - start,
+    "first_data_s": first_data - start
+}))
+"""
+
+METRICS = ["import_s", "ready_s", "first_data_s"]
+
+
+def run_probe() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    # Dòng cuối là JSON, phía trên có thể là log của load_data
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--save", help="Ghi kết quả (median) ra file JSON làm baseline")
+    parser.add_argument("--baseline", help="So sánh với baseline JSON, exit 1 nếu regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Ngưỡng chậm hơn cho phép (0.2 = 20%%)")
+    args = parser.parse_args()
+    
+    samples = [run_probe() for _ in range(args.runs)]
+    result = {metric: statistics.median(s[metric] for s in samples) for metric in METRICS}
+    
+    print(f"📊 Startup ({args.runs} lần, median):")
+    for metric in METRICS:
+        print(f"   {metric:>13}: {result[metric] * 1000:8.1f} ms")
+    
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"💾 Đã lưu baseline: {args.save}")
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = []
+        for metric in METRICS:
+            if metric not in baseline:
+                continue
+            ratio = result[metric] / baseline[metric]
+            status = "❌" if ratio > 1 + args.tolerance else "✅"
+            print(f"   {status} {metric}: {baseline[metric] * 1000:.1f} ms -> {result[metric] * 1000:.1f} ms ({ratio:.2f}x)")
+            if ratio > 1 + args.tolerance:
+                regressions.append(metric)
+        if regressions:
+            sys.exit(f"Regression: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -60,6 +60,7 @@ if "messages" not in st.session_state:
 
 # API configuration
 API_BASE_URL = os.getenv("API_BASE_URL", "http://localhost:8000")
+CHAT_STREAMING = os.getenv("CHAT_STREAMING", "true").lower() == "true"
 
 def call_chat_api(query):
     """Call the chat API endpoint"""
@@ -81,6 +82,59 @@ def call_chat_api(query):
     except json.JSONDecodeError:
         return {"success": False, "error": "Lỗi phản hồi từ API"}
 
+def call_chat_stream_api(query, on_token=None):
+    """
+    Call the streaming chat endpoint (server-sent events)
+
+    on_token(text) is called with the accumulated answer every time a new
+    token arrives. Returns the same dict shape as call_chat_api.
+    """
+    result = {"success": False, "error": "Không nhận được phản hồi từ API"}
+    answer = ""
+    try:
+        with requests.post(
+            f"{API_BASE_URL}/chat/stream",
+            headers={"Content-Type": "application/json", "Accept": "text/event-stream"},
+            json={"query": query},
+            stream=True,
+            timeout=30
+        ) as response:
+            response.raise_for_status()
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                    continue
+                if not line.startswith("data:"):
+                    continue
+                data = json.loads(line[len("data:"):].strip())
+                
+                if event == "apartment":
+                    result.update(data)
+                elif event == "images":
+                    result["images_urls"] = data.get("images_urls", {})
+                    if "overview_images_urls" in data:
+                        result["overview_images_urls"] = data["overview_images_urls"]
+                elif event == "token":
+                    answer += data.get("content", "")
+                    if on_token:
+                        on_token(answer)
+                elif event == "done":
+                    result["success"] = True
+                    result["message"] = data.get("message", answer)
+                    result.pop("error", None)
+                elif event == "error":
+                    result = {"success": False, "error": data.get("message", "Có lỗi xảy ra khi xử lý yêu cầu")}
+        return result
+    except requests.exceptions.ConnectionError:
+        return {"success": False, "error": "Không thể kết nối đến API. Vui lòng kiểm tra server có đang chạy không."}
+    except requests.exceptions.Timeout:
+        return {"success": False, "error": "API timeout. Vui lòng thử lại."}
+    except requests.exceptions.RequestException as e:
+        return {"success": False, "error": f"Lỗi API: {str(e)}"}
+    except json.JSONDecodeError:
+        return {"success": False, "error": "Lỗi phản hồi từ API"}
+
 def display_message(message, is_user=False):
     """Display a chat message"""
     message_class = "user-message" if is_user else "assistant-message"
@@ -115,6 +169,12 @@ def display_apartment_info(apartment_info):
         st.write(f"**💰 Giá bán:** {apartment_info.get('giá_formatted', 'N/A')}")
         st.write(f"**📍 Căn góc:** {'✅ Có' if apartment_info.get('căn_góc') else '❌ Không'}")
 
+def resolve_image_url(url):
+    """URL ảnh tương đối (/images/... khi backend dùng IMAGE_STORAGE=local) -> URL đầy đủ"""
+    if url.startswith("/"):
+        return f"{API_BASE_URL}{url}"
+    return url
+
 def display_images(images_urls):
     """Display apartment images"""
     if images_urls:
@@ -125,12 +185,27 @@ def display_images(images_urls):
         with col1:
             if "blueprint" in images_urls:
                 st.markdown("**📐 Bản vẽ kỹ thuật:**")
-                st.image(images_urls["blueprint"], caption="Blueprint", use_column_width=True)
+                st.image(resolve_image_url(images_urls["blueprint"]), caption="Blueprint", use_column_width=True)
         
         with col2:
             if "map" in images_urls:
                 st.markdown("**🗺️ Sơ đồ vị trí:**")
-                st.image(images_urls["map"], caption="Map", use_column_width=True)
+                st.image(resolve_image_url(images_urls["map"]), caption="Map", use_column_width=True)
+
+def display_overview_images(overview_images_urls):
+    """Display one overview image per layer with all matching apartments marked"""
+    if overview_images_urls:
+        st.markdown("### 🗺️ Tổng quan các căn phù hợp")
+        
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            if "blueprint" in overview_images_urls:
+                st.image(resolve_image_url(overview_images_urls["blueprint"]), caption="Blueprint", use_column_width=True)
+        
+        with col2:
+            if "map" in overview_images_urls:
+                st.image(resolve_image_url(overview_images_urls["map"]), caption="Map", use_column_width=True)
 
 # Main UI
 st.title("🏠 Apartment Search Chat")
@@ -166,6 +241,10 @@ with chat_container:
             # Display images if available
             if "images_urls" in message:
                 display_images(message["images_urls"])
+            
+            # Display overview of all matches if available
+            if "overview_images_urls" in message:
+                display_overview_images(message["overview_images_urls"])
                 
             # Display total found
             if "total_found" in message:
@@ -196,10 +275,19 @@ if user_input:
         "timestamp": datetime.now()
     })
     
-    # Show loading spinner
-    with st.spinner("Đang tìm kiếm thông tin căn hộ..."):
-        # Call API
-        response = call_chat_api(user_input)
+    if CHAT_STREAMING:
+        # Hiển thị câu trả lời ngay khi từng token về
+        stream_placeholder = st.empty()
+        with st.spinner("Đang tìm kiếm thông tin căn hộ..."):
+            response = call_chat_stream_api(
+                user_input,
+                on_token=lambda text: stream_placeholder.markdown(text)
+            )
+    else:
+        # Show loading spinner
+        with st.spinner("Đang tìm kiếm thông tin căn hộ..."):
+            # Call API
+            response = call_chat_api(user_input)
     
     if response.get("success"):
         # Add assistant response to chat history
@@ -215,6 +303,9 @@ if user_input:
         
         if "images_urls" in response:
             assistant_message["images_urls"] = response["images_urls"]
+        
+        if "overview_images_urls" in response:
+            assistant_message["overview_images_urls"] = response["overview_images_urls"]
             
         if "total_found" in response:
             assistant_message["total_found"] = response["total_found"]
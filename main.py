@@ -4,59 +4,810 @@ Apartment Search API - FastAPI server
 Tìm kiếm căn hộ và trả về ảnh đã zoom + đánh dấu vị trí
 """
 
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import Response
-import pandas as pd
-import cv2
-import numpy as np
+from __future__ import annotations
+
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 import io
 import base64
 from typing import Dict, Tuple, Optional, List
 import os
-import requests
+import sys
+import asyncio
+import importlib.util
 import tempfile
-import openai
 import json
 import re
+import hashlib
+import sqlite3
+import threading
+import time
+import contextvars
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from dotenv import load_dotenv
 
+def lazy_import(name: str):
+    """
+    Import module kiểu lazy: module chỉ thực sự được load ở lần truy cập
+    thuộc tính đầu tiên. Giúp `import main` nhanh (worker spawn, test collection)
+    vì pandas/cv2/openai... chỉ load khi cần.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+pd = lazy_import("pandas")
+cv2 = lazy_import("cv2")
+np = lazy_import("numpy")
+httpx = lazy_import("httpx")
+openai = lazy_import("openai")
+
 # Load environment variables
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Khởi tạo / dọn dẹp tài nguyên dùng chung của app"""
+    if not os.getenv("OPENAI_API_KEY"):
+        print("⚠️ OPENAI_API_KEY chưa được cấu hình, câu hỏi cần OpenAI sẽ nhận lỗi cấu hình (success=false)")
+    
+    warmup_task = None
+    warmup = os.getenv("WARMUP_ON_STARTUP", "false").lower() == "true"
+    if warmup or os.getenv("PRELOAD_DATA", "false").lower() == "true":
+        # Load data + khởi tạo OpenAI client ngay khi khởi động thay vì ở request đầu tiên
+        await asyncio.gather(
+            asyncio.to_thread(get_searcher),
+            asyncio.to_thread(preload_openai_client)
+        )
+    if warmup:
+        # Pre-render ở background để worker nhận request ngay
+        warmup_task = asyncio.create_task(asyncio.to_thread(
+            warm_up,
+            get_searcher(),
+            parse_warmup_specs(os.getenv("WARMUP_ZOOM_SIZES", DEFAULT_WARMUP_SPECS)),
+            upload=os.getenv("WARMUP_UPLOAD", "false").lower() == "true",
+            loop=asyncio.get_running_loop()
+        ))
+    # Hot reload: tự load lại data/ và images/ khi file thay đổi
+    data_watcher = DataWatcher(DATA_WATCH_INTERVAL) if DATA_WATCH_INTERVAL > 0 else None
+    if data_watcher is not None:
+        data_watcher.start()
+    upload_queue.start()
+    yield
+    await upload_queue.stop()
+    if data_watcher is not None:
+        data_watcher.stop()
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    await close_http_client()
+    render_executor.shutdown()
+
 app = FastAPI(
     title="Apartment Search API",
     description="API để tìm kiếm căn hộ và trả về ảnh đã zoom với marker đỏ",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+# Bucket (giây) cho histogram latency theo stage và theo request
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Tên metric -> (loại, mô tả) cho dòng # TYPE / # HELP
+METRIC_DESCRIPTIONS = {
+    "apartment_stage_duration_seconds": ("histogram", "Thời gian từng stage xử lý (filter, coords, render, encode, upload, llm)"),
+    "apartment_http_request_duration_seconds": ("histogram", "Thời gian xử lý request HTTP (tới khi gửi header)"),
+    "apartment_http_requests_total": ("counter", "Số request HTTP theo route và status"),
+    "apartment_in_flight": ("gauge", "Số request / upload / lời gọi LLM đang chạy"),
+    "apartment_upload_errors_total": ("counter", "Số lần upload Cloudinary lỗi theo nguyên nhân"),
+    "apartment_upload_fallbacks_total": ("counter", "Số ảnh phải fallback sang base64 vì upload thất bại"),
+    "apartment_llm_errors_total": ("counter", "Số lời gọi OpenAI lỗi"),
+    "apartment_cache_hits_total": ("counter", "Số lần cache hit"),
+    "apartment_cache_misses_total": ("counter", "Số lần cache miss"),
+    "apartment_cache_hit_ratio": ("gauge", "Tỉ lệ cache hit"),
+    "apartment_cache_entries": ("gauge", "Số entry trong cache"),
+    "apartment_render_executor_in_flight": ("gauge", "Số job render đang chờ + đang chạy"),
+    "apartment_render_executor_rejected_total": ("counter", "Số job render bị từ chối vì hàng đợi đầy"),
+    "apartment_upload_jobs_total": ("counter", "Số job upload nền theo trạng thái (queued, done, failed, rejected)"),
+    "apartment_upload_queue_depth": ("gauge", "Số job upload nền đang chờ worker"),
+    "apartment_llm_rejected_total": ("counter", "Số lời gọi OpenAI bị từ chối (circuit_open, queue_timeout)"),
+    "apartment_llm_fallbacks_total": ("counter", "Số câu trả lời dự phòng (template) thay cho OpenAI"),
+    "apartment_llm_circuit_opened_total": ("counter", "Số lần circuit breaker OpenAI mở"),
+    "apartment_llm_circuit_state": ("gauge", "Trạng thái circuit breaker OpenAI (0 = closed, 1 = half-open, 2 = open)"),
+    "apartment_chat_fast_path_total": ("counter", "Câu hỏi chat theo kết quả fast path (hit = trả lời bằng template, không gọi OpenAI)"),
+    "apartment_singleflight_calls_total": ("counter", "Số lời gọi qua single-flight (leader chạy thật, follower dùng chung kết quả)")
+}
+
+
+class Metrics:
+    """
+    Registry metric tối giản, xuất theo Prometheus text format
+
+    Counter / gauge / histogram được định danh bằng (tên, label); label truyền
+    dạng keyword. Mọi thao tác đều thread-safe (gọi từ event loop, thread
+    render và thread upload).
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._values = {}
+        self._histograms = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Tăng counter (hoặc gauge nếu value âm)"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # [count theo từng bucket..., sum, count]
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    @staticmethod
+    def _format_labels(labels: Tuple, extra: Tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ""
+        escaped = (
+            '{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs
+        )
+        return "{" + ",".join(escaped) + "}"
+
+    def render(self, extra_values: Optional[List[Tuple[str, Dict, float]]] = None) -> str:
+        """Xuất tất cả metric (kèm extra_values thu thập lúc scrape) dạng text"""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(h) for key, h in self._histograms.items()}
+        for name, labels, value in extra_values or []:
+            values[self._key(name, labels)] = value
+        
+        lines = []
+        described = set()
+        
+        def describe(name):
+            if name not in described and name in METRIC_DESCRIPTIONS:
+                kind, help_text = METRIC_DESCRIPTIONS[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            described.add(name)
+        
+        for (name, labels), value in sorted(values.items()):
+            describe(name)
+            lines.append(f"{name}{self._format_labels(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            describe(name)
+            for bound, count in zip(self.buckets, histogram):
+                lines.append(f"{name}_bucket{self._format_labels(labels, (('le', str(bound)),))} {count}")
+            lines.append(f"{name}_bucket{self._format_labels(labels, (('le', '+Inf'),))} {histogram[-1]}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {histogram[-2]}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {histogram[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# Danh sách (stage, giây) của request hiện tại, dùng cho header Server-Timing
+_request_timings: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "request_timings", default=None
+)
+
+def record_stage(name: str, seconds: float):
+    """Ghi thời gian một stage vào histogram và vào breakdown của request hiện tại"""
+    metrics.observe("apartment_stage_duration_seconds", seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings.append((name, seconds))
+
+@contextmanager
+def stage(name: str):
+    """Đo thời gian khối lệnh: `with stage("render"): ...`"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started_at)
+
+@contextmanager
+def in_flight(kind: str):
+    """Gauge số tác vụ `kind` đang chạy"""
+    metrics.inc("apartment_in_flight", 1, kind=kind)
+    try:
+        yield
+    finally:
+        metrics.inc("apartment_in_flight", -1, kind=kind)
+
+def server_timing_header(timings: List[Tuple[str, float]], total: float) -> str:
+    """Gộp các stage cùng tên (cộng dồn thời gian) thành header Server-Timing"""
+    totals = {}
+    for name, seconds in timings:
+        count, summed = totals.get(name, (0, 0.0))
+        totals[name] = (count + 1, summed + seconds)
+    entries = [
+        f'{name};desc="x{count}";dur={summed * 1000:.1f}' if count > 1 else f"{name};dur={summed * 1000:.1f}"
+        for name, (count, summed) in totals.items()
+    ]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """
+    Đo latency từng request + thêm header Server-Timing với breakdown theo stage
+
+    Với response streaming (/chat/stream), thời gian và breakdown chỉ tính tới
+    lúc gửi header; các stage chạy sau đó vẫn được ghi vào histogram.
+    """
+    timings = []
+    token = _request_timings.set(timings)
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        with in_flight("http"):
+            response = await call_next(request)
+        status = response.status_code
+    finally:
+        _request_timings.reset(token)
+        elapsed = time.perf_counter() - started_at
+        # Dùng path template của route để label không bùng nổ theo tham số
+        route = request.scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        metrics.observe("apartment_http_request_duration_seconds", elapsed, method=request.method, path=path)
+        metrics.inc("apartment_http_requests_total", method=request.method, path=path, status=status)
+    response.headers["Server-Timing"] = server_timing_header(timings, elapsed)
+    return response
+
+class ApartmentCoordCatalog:
+    """
+    Bảng tra tọa độ căn hộ bất biến, build một lần trong load_data
+
+    Lưu tọa độ blueprint/map trong mảng numpy liền khối (int32, shape (n, 2)),
+    căn không có trên một layer được đánh dấu bằng MISSING. Tra cứu theo
+    apartment_id là O(1) qua dict id -> vị trí dòng.
+    """
+
+    MISSING = -1
+
+    def __init__(self, blueprint_data: pd.DataFrame, map_data: pd.DataFrame):
+        ids = list(dict.fromkeys(
+            blueprint_data['Apartment'].astype(str).tolist() + map_data['Apartment'].astype(str).tolist()
+        ))
+        self._index = {apartment_id: i for i, apartment_id in enumerate(ids)}
+        self._ids = tuple(ids)
+        self._blueprint = self._build_layer(blueprint_data)
+        self._map = self._build_layer(map_data)
+
+    def _build_layer(self, layer_data: pd.DataFrame) -> np.ndarray:
+        coords = np.full((len(self._ids), 2), self.MISSING, dtype=np.int32)
+        # Giữ dòng đầu tiên nếu CSV có ID trùng (giống hành vi .iloc[0] trước đây)
+        layer_data = layer_data.drop_duplicates(subset='Apartment', keep='first')
+        rows = np.fromiter(
+            (self._index[a] for a in layer_data['Apartment'].astype(str)),
+            dtype=np.intp, count=len(layer_data)
+        )
+        coords[rows, 0] = layer_data['X'].to_numpy(dtype=np.int32)
+        coords[rows, 1] = layer_data['Y'].to_numpy(dtype=np.int32)
+        coords.flags.writeable = False
+        return coords
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, apartment_id: str) -> bool:
+        return apartment_id in self._index
+
+    @property
+    def ids(self) -> Tuple[str, ...]:
+        return self._ids
+
+    def layer_ids(self, image_type: str) -> List[str]:
+        """Danh sách ID có tọa độ trên một layer ("blueprint" hoặc "map")"""
+        coords = self._layer(image_type)
+        present = coords[:, 0] != self.MISSING
+        return [self._ids[i] for i in np.flatnonzero(present)]
+
+    def layer_points(self, image_type: str) -> Tuple[List[str], np.ndarray]:
+        """(ID, tọa độ shape (k, 2)) của các căn có trên một layer"""
+        coords = self._layer(image_type)
+        rows = np.flatnonzero(coords[:, 0] != self.MISSING)
+        return [self._ids[i] for i in rows], coords[rows]
+
+    def _layer(self, image_type: str) -> np.ndarray:
+        if image_type == "blueprint":
+            return self._blueprint
+        if image_type == "map":
+            return self._map
+        raise ValueError(f"Layer không hợp lệ: {image_type}")
+
+    def _point(self, coords: np.ndarray, row: int) -> Optional[Tuple[int, int]]:
+        x, y = coords[row]
+        if x == self.MISSING:
+            return None
+        return int(x), int(y)
+
+    def get(self, apartment_id: str) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """Trả về (blueprint_coords, map_coords) của một căn, None nếu không có"""
+        row = self._index.get(apartment_id)
+        if row is None:
+            return None, None
+        return self._point(self._blueprint, row), self._point(self._map, row)
+
+    def get_many(self, apartment_ids: List[str]) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Tra cứu hàng loạt
+
+        Returns:
+            Dict {"blueprint": array (n, 2), "map": array (n, 2)} theo đúng thứ tự
+            apartment_ids; dòng không có tọa độ mang giá trị MISSING.
+        """
+        rows = np.fromiter(
+            (self._index.get(a, -1) for a in apartment_ids), dtype=np.intp, count=len(apartment_ids)
+        )
+        known = rows >= 0
+        result = {}
+        for image_type, coords in (("blueprint", self._blueprint), ("map", self._map)):
+            out = np.full((len(apartment_ids), 2), self.MISSING, dtype=np.int32)
+            out[known] = coords[rows[known]]
+            result[image_type] = out
+        return result
+
+
+class SpatialGrid:
+    """
+    Grid index cho tọa độ căn hộ trên một layer: tìm căn tại điểm click và các căn trong viewport
+
+    Điểm được chia vào các ô vuông cạnh cell_size (mặc định sao cho mỗi ô có
+    khoảng 2 điểm), lưu kiểu CSR: mảng điểm sắp theo mã ô + vị trí bắt đầu mỗi
+    ô. Các ô trên cùng một hàng nằm liền nhau nên một viewport chỉ cần một
+    slice mỗi hàng; chi phí tỉ lệ với số hàng ô + số điểm trả về, không phụ
+    thuộc tổng số căn.
+    """
+
+    def __init__(self, ids: List[str], points: np.ndarray, cell_size: Optional[int] = None):
+        self.size = len(ids)
+        points = np.asarray(points, dtype=np.int64).reshape(-1, 2)
+        if self.size:
+            self.origin = points.min(axis=0)
+            extent = points.max(axis=0) - self.origin + 1
+        else:
+            self.origin = np.zeros(2, dtype=np.int64)
+            extent = np.ones(2, dtype=np.int64)
+        if cell_size is None:
+            cell_size = int(np.ceil(np.sqrt(2 * extent[0] * extent[1] / max(self.size, 1))))
+        self.cell_size = max(1, cell_size)
+        self.cols, self.rows = (int(v) for v in extent // self.cell_size + 1)
+        
+        cells = self._cell_ids(points)
+        order = np.argsort(cells, kind="stable")
+        self._ids = [ids[i] for i in order]
+        self._points = points[order]
+        self._points.flags.writeable = False
+        self._starts = np.searchsorted(cells[order], np.arange(self.cols * self.rows + 1))
+
+    def _cell_ids(self, points: np.ndarray) -> np.ndarray:
+        cell = (points - self.origin) // self.cell_size
+        return cell[:, 1] * self.cols + cell[:, 0]
+
+    def _box_rows(self, x_min: float, y_min: float, x_max: float, y_max: float) -> np.ndarray:
+        """Vị trí (trong mảng đã sắp) của các điểm thuộc các ô giao với hộp"""
+        cx0, cy0 = ((np.array([x_min, y_min]) - self.origin) // self.cell_size).astype(np.int64)
+        cx1, cy1 = ((np.array([x_max, y_max]) - self.origin) // self.cell_size).astype(np.int64)
+        cx0, cx1 = max(cx0, 0), min(cx1, self.cols - 1)
+        cy0, cy1 = max(cy0, 0), min(cy1, self.rows - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.intp)
+        slices = [
+            np.arange(self._starts[cy * self.cols + cx0], self._starts[cy * self.cols + cx1 + 1])
+            for cy in range(cy0, cy1 + 1)
+        ]
+        return np.concatenate(slices)
+
+    def within(self, x_min: float, y_min: float, x_max: float, y_max: float,
+               limit: Optional[int] = None) -> List[Tuple[str, Tuple[int, int]]]:
+        """Các căn có tọa độ trong hộp [x_min, x_max] x [y_min, y_max], theo thứ tự (y, x)"""
+        if not self.size:
+            return []
+        rows = self._box_rows(x_min, y_min, x_max, y_max)
+        points = self._points[rows]
+        inside = rows[
+            (points[:, 0] >= x_min) & (points[:, 0] <= x_max) &
+            (points[:, 1] >= y_min) & (points[:, 1] <= y_max)
+        ]
+        inside = inside[np.lexsort((self._points[inside, 0], self._points[inside, 1]))]
+        if limit is not None:
+            inside = inside[:limit]
+        return [(self._ids[i], (int(self._points[i, 0]), int(self._points[i, 1]))) for i in inside]
+
+    def nearest(self, x: float, y: float, max_distance: float) -> Optional[Tuple[str, Tuple[int, int], float]]:
+        """
+        Căn gần (x, y) nhất trong bán kính max_distance, None nếu không có
+
+        Mở rộng hộp tìm kiếm quanh ô chứa điểm (gấp đôi mỗi vòng) cho tới khi
+        điểm tốt nhất chắc chắn gần hơn mọi điểm nằm ngoài hộp.
+        """
+        if not self.size:
+            return None
+        radius = min(self.cell_size, max_distance)
+        while True:
+            rows = self._box_rows(x - radius, y - radius, x + radius, y + radius)
+            if len(rows):
+                deltas = self._points[rows] - np.array([x, y])
+                distances = np.hypot(deltas[:, 0], deltas[:, 1])
+                best = int(np.argmin(distances))
+                # Mọi điểm ngoài hộp cách (x, y) ít nhất `radius`
+                if distances[best] <= radius:
+                    if distances[best] > max_distance:
+                        return None
+                    i = rows[best]
+                    return self._ids[i], (int(self._points[i, 0]), int(self._points[i, 1])), float(distances[best])
+            if radius >= max_distance:
+                return None
+            radius = min(radius * 2, max_distance)
+
+
+class RenderCache:
+    """
+    LRU cache cho ảnh crop đã render, giới hạn theo tổng số byte
+
+    Key: (apartment_id, image_type, tọa độ, zoom_size, tầng pyramid, hash ảnh), thêm
+    encoding ở cuối nếu khác JPEG mặc định. Mỗi entry giữ ảnh đã render (read-only,
+    dùng chung giữa các request) và bytes đã encode sẵn. Các entry khác encoding
+    của cùng một ảnh dùng chung mảng ảnh nhưng vẫn tính byte riêng (ước lượng dư).
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _entry_size(image: np.ndarray, encoded: bytes) -> int:
+        return image.nbytes + len(encoded)
+
+    def get(self, key: Tuple) -> Optional[Tuple[np.ndarray, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Tuple, image: np.ndarray, encoded: bytes):
+        size = self._entry_size(image, encoded)
+        if size > self.max_bytes:
+            # Ảnh lớn hơn cả budget thì không cache
+            return
+        image.flags.writeable = False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= self._entry_size(*old)
+            self._entries[key] = (image, encoded)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= self._entry_size(*evicted)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def invalidate(self, predicate) -> int:
+        """Xóa các entry có predicate(key) đúng, trả về số entry đã xóa"""
+        with self._lock:
+            stale = [key for key in self._entries if predicate(key)]
+            for key in stale:
+                self.current_bytes -= self._entry_size(*self._entries.pop(key))
+            return len(stale)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
+
+
+class SheetFilterIndex:
+    """
+    Index dạng cột cho sheet.csv, build một lần trong load_data
+
+    - Bitmap (mảng bool) cho từng giá trị của các cột lọc bằng (phân khu, tầng,
+      căn góc, số căn, loại hình)
+    - Mảng thứ tự đã sort sẵn cho các cột số (giá, diện tích) để lọc khoảng bằng
+      searchsorted và trả kết quả theo thứ tự mà không cần sort lại
+    - Danh sách record (dict) tạo sẵn, query không copy DataFrame
+    """
+
+    EQUALITY_COLUMNS = ["PHÂN KHU", "Tầng", "căn góc", "Căn STT", "Loại hình"]
+    RANGE_COLUMNS = {
+        "price": "Tổng giá trước VAT + KPBT",
+        "area": "DT tim tường",
+        "net_area": "DT thông thủy",
+        "floor": "Tầng",
+        "apartment_number": "Căn STT"
+    }
+
+    def __init__(self, sheet_data: pd.DataFrame):
+        self._size = len(sheet_data)
+        self._records = sheet_data.to_dict('records')
+        
+        self._bitmaps = {}
+        for column in self.EQUALITY_COLUMNS:
+            if column not in sheet_data.columns:
+                continue
+            codes, uniques = pd.factorize(sheet_data[column])
+            bitmaps = {}
+            for code, value in enumerate(uniques.tolist()):
+                bitmap = codes == code
+                bitmap.flags.writeable = False
+                bitmaps[value] = bitmap
+            self._bitmaps[column] = bitmaps
+        
+        self._sorted = {}
+        for name, column in self.RANGE_COLUMNS.items():
+            if column not in sheet_data.columns:
+                continue
+            values = sheet_data[column].to_numpy(dtype=np.float64)
+            order = np.argsort(values, kind="stable")
+            sorted_values = values[order]
+            order.flags.writeable = False
+            sorted_values.flags.writeable = False
+            self._sorted[name] = (order, sorted_values)
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def sortable_fields(self) -> List[str]:
+        return list(self._sorted.keys())
+
+    def _equality_mask(self, column: str, value) -> Optional[np.ndarray]:
+        bitmaps = self._bitmaps.get(column)
+        if bitmaps is None:
+            # Cột không tồn tại trong sheet thì bỏ qua bộ lọc (giống hành vi cũ)
+            return None
+        bitmap = bitmaps.get(value)
+        if bitmap is None:
+            return np.zeros(self._size, dtype=bool)
+        return bitmap
+
+    def _range_mask(self, name: str, low: Optional[float], high: Optional[float]) -> np.ndarray:
+        order, sorted_values = self._sorted[name]
+        start = 0 if low is None else np.searchsorted(sorted_values, low, side="left")
+        end = np.searchsorted(sorted_values, np.inf if high is None else high, side="right")
+        mask = np.zeros(self._size, dtype=bool)
+        mask[order[start:end]] = True
+        return mask
+
+    def query(self, filters: Optional[Dict] = None, ranges: Optional[Dict[str, Tuple[Optional[float], Optional[float]]]] = None,
+              sort_by: Optional[str] = None, descending: bool = False, limit: Optional[int] = None) -> List[Dict]:
+        """
+        Lọc căn hộ theo bộ lọc bằng + khoảng giá trị
+
+        Args:
+            filters: Dict cột -> giá trị (VD: {"PHÂN KHU": "Origami", "Tầng": 2})
+            ranges: Dict tên field -> (min, max), None là không giới hạn
+                    (field: price, area, net_area, floor, apartment_number)
+            sort_by: Sắp xếp theo field số (như ranges), None = thứ tự trong sheet
+            descending: Sắp xếp giảm dần
+            limit: Số kết quả tối đa
+
+        Returns:
+            List record (dict) của các căn phù hợp
+        """
+        mask = np.ones(self._size, dtype=bool)
+        for column, value in (filters or {}).items():
+            column_mask = self._equality_mask(column, value)
+            if column_mask is not None:
+                mask &= column_mask
+        for name, (low, high) in (ranges or {}).items():
+            if name not in self._sorted:
+                raise ValueError(f"Không hỗ trợ lọc khoảng theo: {name}")
+            mask &= self._range_mask(name, low, high)
+        
+        if sort_by is None:
+            indices = np.flatnonzero(mask)
+            if descending:
+                indices = indices[::-1]
+        else:
+            if sort_by not in self._sorted:
+                raise ValueError(f"Không hỗ trợ sắp xếp theo: {sort_by}")
+            order = self._sorted[sort_by][0]
+            indices = order[mask[order]]
+            if descending:
+                indices = indices[::-1]
+        
+        if limit is not None:
+            indices = indices[:limit]
+        return [dict(self._records[i]) for i in indices]
+
+
+def file_digest(path: str) -> str:
+    """SHA-256 (hex) của nội dung file"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Mảng màu đỏ cấp phát sẵn để blend marker, dùng chung cho mọi lần render (chỉ đọc)
+_marker_fill_buffer = None
+
+def marker_fill(height: int, width: int) -> np.ndarray:
+    """View (height, width) trên buffer màu đỏ dùng chung, chỉ cấp phát lại khi cần lớn hơn"""
+    global _marker_fill_buffer
+    buffer = _marker_fill_buffer
+    if buffer is None or buffer.shape[0] < height or buffer.shape[1] < width:
+        size = max(height, width, 0 if buffer is None else buffer.shape[0], 256)
+        buffer = np.empty((size, size, 3), dtype=np.uint8)
+        buffer[:] = (0, 0, 255)
+        buffer.flags.writeable = False
+        _marker_fill_buffer = buffer
+    return buffer[:height, :width]
+
+OVERVIEW_PADDING = int(os.getenv("OVERVIEW_PADDING", 200))
+
+PYRAMID_MIN_SIZE = int(os.getenv("PYRAMID_MIN_SIZE", 256))
+
+def build_image_pyramid(image: np.ndarray, min_size: int = PYRAMID_MIN_SIZE) -> List[np.ndarray]:
+    """
+    Tạo image pyramid: tầng 0 là ảnh gốc, mỗi tầng sau giảm một nửa (cv2.pyrDown)
+    cho đến khi cạnh ngắn nhỏ hơn min_size
+    """
+    levels = [image]
+    while min(levels[-1].shape[:2]) // 2 >= min_size:
+        levels.append(cv2.pyrDown(levels[-1]))
+    for level in levels[1:]:
+        level.flags.writeable = False
+    return levels
+
+def fit_to_max_dim(image: np.ndarray, max_dim: Optional[int]) -> np.ndarray:
+    """Thu nhỏ ảnh (INTER_AREA) để cạnh dài không vượt quá max_dim, dùng khi pyramid đã hết tầng"""
+    height, width = image.shape[:2]
+    if not max_dim or max(height, width) <= max_dim:
+        return image
+    factor = max_dim / max(height, width)
+    size = (max(1, min(max_dim, round(width * factor))), max(1, min(max_dim, round(height * factor))))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+# Định dạng ảnh output: tên -> (đuôi file cho cv2.imencode, MIME type)
+IMAGE_FORMATS = {
+    "jpeg": (".jpg", "image/jpeg"),
+    "webp": (".webp", "image/webp"),
+    "png": (".png", "image/png")
+}
+
+# (định dạng, quality, progressive); quality None = mặc định của OpenCV (JPEG 95)
+DEFAULT_ENCODING = ("jpeg", None, False)
+
+# Mặc định của OpenCV cho WebP là 100 (lossless, thường lớn hơn cả JPEG)
+WEBP_DEFAULT_QUALITY = 80
+
+def make_encoding(image_format: str = "jpeg", quality: Optional[int] = None, progressive: bool = False) -> Tuple:
+    """
+    Chuẩn hóa tham số encode thành tuple dùng làm key cache
+
+    PNG là lossless nên bỏ qua quality; progressive chỉ áp dụng cho JPEG.
+    Raise ValueError nếu định dạng / quality không hợp lệ.
+    """
+    image_format = image_format.lower()
+    if image_format == "jpg":
+        image_format = "jpeg"
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Định dạng ảnh không hỗ trợ: {image_format} (chỉ hỗ trợ {', '.join(IMAGE_FORMATS)})")
+    if quality is not None and not 1 <= quality <= 100:
+        raise ValueError("quality phải trong khoảng 1-100")
+    if image_format == "png":
+        quality = None
+    elif image_format == "webp" and quality is None:
+        quality = WEBP_DEFAULT_QUALITY
+    return image_format, quality, bool(progressive) and image_format == "jpeg"
+
+def encode_image(image: np.ndarray, encoding: Tuple = DEFAULT_ENCODING) -> bytes:
+    """Encode ảnh theo encoding (kết quả của make_encoding)"""
+    image_format, quality, progressive = encoding
+    params = []
+    if image_format == "jpeg":
+        if quality is not None:
+            params += [cv2.IMWRITE_JPEG_QUALITY, quality]
+        if progressive:
+            params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+    elif image_format == "webp" and quality is not None:
+        params += [cv2.IMWRITE_WEBP_QUALITY, quality]
+    ok, buffer = cv2.imencode(IMAGE_FORMATS[image_format][0], image, params)
+    if not ok:
+        raise ValueError(f"Không encode được ảnh sang {image_format}")
+    return buffer.tobytes()
+
+def encoding_suffix(encoding: Tuple) -> str:
+    """Hậu tố public_id cho encoding khác mặc định (VD: "_webpq80", "_jpegq70p")"""
+    if encoding == DEFAULT_ENCODING:
+        return ""
+    image_format, quality, progressive = encoding
+    return f"_{image_format}" + (f"q{quality}" if quality is not None else "") + ("p" if progressive else "")
+
+
+DATA_WATCH_INTERVAL = float(os.getenv("DATA_WATCH_INTERVAL", 5))
+
+# Các nguồn dữ liệu của ApartmentSearcher: tên -> đường dẫn tương đối
+DATA_SOURCES = {
+    "blueprint_csv": os.path.join("data", "blueprint.csv"),
+    "map_csv": os.path.join("data", "map.csv"),
+    "sheet_csv": os.path.join("data", "sheet.csv"),
+    "blueprint_image": os.path.join("images", "blueprint.jpg"),
+    "map_image": os.path.join("images", "map.jpg")
+}
+
+
 class ApartmentSearcher:
-    def __init__(self):
+    def __init__(self, data_dir: Optional[str] = None):
         self.blueprint_data = None
         self.map_data = None
         self.sheet_data = None
         self.blueprint_image = None
         self.map_image = None
+        self.coord_catalog = None
+        self.spatial_index = {}
+        self.sheet_version = None
+        self.filter_index = None
+        self.image_pyramids = {}
+        self.image_digests = {}
+        self.render_cache = RenderCache(
+            max_bytes=int(os.getenv("RENDER_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+        )
+        # Thư mục chứa data/ và images/ (mặc định cạnh main.py)
+        self.data_dir = data_dir or os.path.dirname(os.path.abspath(__file__))
+        # source -> (mtime_ns, size, sha256) của lần load gần nhất
+        self._fingerprints = {}
+        self._data_version = None
+        self._apartments_summary = None
+        self._swap_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._last_check = time.monotonic()
         self.load_data()
     
     def load_data(self):
         """Load CSV data và images"""
         try:
-            # Get current directory
-            current_dir = os.path.dirname(os.path.abspath(__file__))
-            
-            # Load CSV data
-            self.blueprint_data = pd.read_csv(os.path.join(current_dir, "data", "blueprint.csv"))
-            self.map_data = pd.read_csv(os.path.join(current_dir, "data", "map.csv"))
-            self.sheet_data = pd.read_csv(os.path.join(current_dir, "data", "sheet.csv"))
-            
-            # Load images
-            self.blueprint_image = cv2.imread(os.path.join(current_dir, "images", "blueprint.jpg"))
-            self.map_image = cv2.imread(os.path.join(current_dir, "images", "map.jpg"))
-            
-            if self.blueprint_image is None:
-                raise FileNotFoundError("blueprint.jpg not found")
-            if self.map_image is None:
-                raise FileNotFoundError("map.jpg not found")
+            self.reload_sources(set(DATA_SOURCES))
                 
             print("✅ Đã load thành công:")
             print(f"   📊 Blueprint: {len(self.blueprint_data)} căn hộ")
@@ -64,44 +815,199 @@ class ApartmentSearcher:
             print(f"   � Sheet: {len(self.sheet_data)} căn hộ")
             print(f"   �🖼️  Blueprint image: {self.blueprint_image.shape}")
             print(f"   🖼️  Map image: {self.map_image.shape}")
+            print(f"   🔺 Pyramid levels: blueprint={len(self.image_pyramids['blueprint'])}, "
+                  f"map={len(self.image_pyramids['map'])}")
             
         except Exception as e:
             print(f"❌ Lỗi load data: {e}")
             raise
     
-    def get_apartment_coords(self, apartment_id: str) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
-        """Lấy tọa độ của căn hộ từ cả 2 file CSV"""
-        # Tìm trong blueprint
-        blueprint_row = self.blueprint_data[self.blueprint_data['Apartment'] == apartment_id]
-        blueprint_coords = None
-        if not blueprint_row.empty:
-            blueprint_coords = (int(blueprint_row.iloc[0]['X']), int(blueprint_row.iloc[0]['Y']))
+    def _source_path(self, source: str) -> str:
+        return os.path.join(self.data_dir, DATA_SOURCES[source])
+    
+    def _fingerprint(self, source: str) -> Tuple[int, int, str]:
+        """(mtime_ns, size, sha256) của file; chỉ hash lại khi mtime/size đổi"""
+        stat = os.stat(self._source_path(source))
+        previous = self._fingerprints.get(source)
+        if previous is not None and previous[:2] == (stat.st_mtime_ns, stat.st_size):
+            return previous
+        return stat.st_mtime_ns, stat.st_size, file_digest(self._source_path(source))
+    
+    @property
+    def data_version(self) -> str:
+        """Version tổng hợp của tất cả nguồn dữ liệu đang dùng (đổi khi bất kỳ file nào đổi)"""
+        return self._data_version
+    
+    def _compute_data_version(self) -> str:
+        digests = ",".join(f"{source}={self._fingerprints[source][2]}" for source in sorted(self._fingerprints))
+        return hashlib.sha256(digests.encode("utf-8")).hexdigest()[:16]
+    
+    def reload_sources(self, sources: set):
+        """
+        Load lại các nguồn dữ liệu đã cho và swap vào searcher
+        
+        Chỉ rebuild các index phụ thuộc: CSV tọa độ -> coord_catalog, sheet.csv ->
+        filter_index, ảnh -> pyramid của layer đó. Object mới được build xong hết
+        rồi mới gán vào searcher trong một lần giữ _swap_lock, request đang chạy
+        tiếp tục dùng object cũ. Sau đó giải phóng các entry render cache không
+        còn khớp dữ liệu mới.
+        """
+        fingerprints = {source: self._fingerprint(source) for source in sources}
+        updates = {}
         
-        # Tìm trong map
-        map_row = self.map_data[self.map_data['Apartment'] == apartment_id]
-        map_coords = None
-        if not map_row.empty:
-            map_coords = (int(map_row.iloc[0]['X']), int(map_row.iloc[0]['Y']))
+        # Load CSV data
+        blueprint_data, map_data = self.blueprint_data, self.map_data
+        if "blueprint_csv" in sources:
+            blueprint_data = pd.read_csv(self._source_path("blueprint_csv"))
+            updates["blueprint_data"] = blueprint_data
+        if "map_csv" in sources:
+            map_data = pd.read_csv(self._source_path("map_csv"))
+            updates["map_data"] = map_data
+        if "blueprint_csv" in sources or "map_csv" in sources:
+            # Build bảng tra tọa độ một lần, tránh quét DataFrame mỗi request
+            coord_catalog = ApartmentCoordCatalog(blueprint_data, map_data)
+            updates["coord_catalog"] = coord_catalog
+            # Grid index cho /locate và /viewport
+            updates["spatial_index"] = {
+                image_type: SpatialGrid(*coord_catalog.layer_points(image_type))
+                for image_type in ("blueprint", "map")
+            }
         
-        return blueprint_coords, map_coords
+        if "sheet_csv" in sources:
+            sheet_data = pd.read_csv(self._source_path("sheet_csv"))
+            updates["sheet_data"] = sheet_data
+            # Version của sheet.csv
+            updates["sheet_version"] = fingerprints["sheet_csv"][2]
+            updates["filter_index"] = SheetFilterIndex(sheet_data)
+        
+        # Load images + pyramid đa độ phân giải cho các request zoom rộng
+        image_types = [image_type for image_type in ("blueprint", "map") if f"{image_type}_image" in sources]
+        if image_types:
+            image_pyramids = dict(self.image_pyramids)
+            image_digests = dict(self.image_digests)
+            for image_type in image_types:
+                image = cv2.imread(self._source_path(f"{image_type}_image"))
+                if image is None:
+                    raise FileNotFoundError(f"{image_type}.jpg not found")
+                updates[f"{image_type}_image"] = image
+                image_pyramids[image_type] = build_image_pyramid(image)
+                image_digests[image_type] = fingerprints[f"{image_type}_image"][2]
+            updates["image_pyramids"] = image_pyramids
+            updates["image_digests"] = image_digests
+        
+        with self._swap_lock:
+            for attribute, value in updates.items():
+                setattr(self, attribute, value)
+            self._fingerprints.update(fingerprints)
+            self._data_version = self._compute_data_version()
+        
+        changed_layers = {source.split("_")[0] for source in sources if source != "sheet_csv"}
+        if changed_layers and self.render_cache.stats()["entries"]:
+            self.render_cache.invalidate(lambda key: self._is_stale_render(key, changed_layers))
+    
+    def _is_stale_render(self, key: Tuple, changed_layers: set) -> bool:
+        """Entry render cache còn khớp với ảnh + tọa độ hiện tại không"""
+        if key[0] == "overview":
+            return key[2] in changed_layers
+        apartment_id, image_type, coords, _, _, digest = key[:6]
+        if digest != self.image_digests.get(image_type):
+            return True
+        blueprint_coords, map_coords = self.coord_catalog.get(apartment_id)
+        return coords != (blueprint_coords if image_type == "blueprint" else map_coords)
+    
+    def check_for_updates(self, min_interval: float = 0) -> set:
+        """
+        So sánh mtime/size (và hash nếu cần) của các file dữ liệu, reload các file đã đổi
+        
+        Args:
+            min_interval: Bỏ qua nếu lần kiểm tra trước cách đây chưa đủ số giây này
+        
+        Returns:
+            Tập các nguồn đã được reload (rỗng nếu không có gì đổi hoặc reload lỗi)
+        """
+        if min_interval and time.monotonic() - self._last_check < min_interval:
+            return set()
+        if not self._reload_lock.acquire(blocking=False):
+            # Đang có thread khác reload
+            return set()
+        try:
+            self._last_check = time.monotonic()
+            changed = set()
+            for source in DATA_SOURCES:
+                try:
+                    fingerprint = self._fingerprint(source)
+                except OSError:
+                    # File đang được ghi đè / tạm thời không tồn tại, giữ dữ liệu cũ
+                    continue
+                if fingerprint[2] != self._fingerprints[source][2]:
+                    changed.add(source)
+                elif fingerprint != self._fingerprints[source]:
+                    # Chỉ mtime đổi, nội dung giữ nguyên: cập nhật để lần sau khỏi hash lại
+                    self._fingerprints[source] = fingerprint
+            if changed:
+                try:
+                    self.reload_sources(changed)
+                    if "sheet_csv" in changed:
+                        answer_cache.purge_stale(self.sheet_version)
+                    print(f"🔄 Đã reload: {', '.join(sorted(changed))} (data version {self.data_version})")
+                except Exception as e:
+                    print(f"❌ Lỗi reload data, tiếp tục dùng dữ liệu cũ: {e}")
+                    return set()
+            return changed
+        finally:
+            self._reload_lock.release()
+    
+    def apartments_summary(self) -> Dict:
+        """
+        Danh sách căn theo layer (dùng cho /apartments)
+
+        Tính một lần cho mỗi cặp blueprint_data / map_data; reload CSV tạo
+        DataFrame mới nên kết quả cũ tự động bị bỏ.
+        """
+        blueprint_data, map_data = self.blueprint_data, self.map_data
+        cached = self._apartments_summary
+        if cached is not None and cached[0] is blueprint_data and cached[1] is map_data:
+            return cached[2]
+        
+        blueprint_apartments = set(blueprint_data['Apartment'].tolist())
+        map_apartments = set(map_data['Apartment'].tolist())
+        all_apartments = sorted(blueprint_apartments.union(map_apartments))
+        summary = {
+            "total": len(all_apartments),
+            "apartments": all_apartments,
+            "blueprint_only": sorted(blueprint_apartments - map_apartments),
+            "map_only": sorted(map_apartments - blueprint_apartments),
+            "both": sorted(blueprint_apartments.intersection(map_apartments))
+        }
+        self._apartments_summary = (blueprint_data, map_data, summary)
+        return summary
+    
+    def get_apartment_coords(self, apartment_id: str) -> Tuple[Optional[Tuple[int, int]], Optional[Tuple[int, int]]]:
+        """Lấy tọa độ của căn hộ từ cả 2 file CSV (tra trong coord_catalog)"""
+        with stage("coords"):
+            return self.coord_catalog.get(apartment_id)
     
     def create_zoomed_image_with_marker(self, image: np.ndarray, coords: Tuple[int, int], 
-                                       zoom_size: int = 400, marker_size: int = 30, image_type: str = "map") -> np.ndarray:
+                                       zoom_size: int = 400, marker_size: int = 30, image_type: str = "map",
+                                       scale: int = 1, blend_mode: str = "roi") -> np.ndarray:
         """
         Tạo ảnh đã zoom vào vị trí căn hộ với marker hộp vuông đỏ
         
         Args:
-            image: Ảnh gốc
-            coords: Tọa độ (x, y) của căn hộ
-            zoom_size: Kích thước vùng zoom (px)
-            marker_size: Kích thước padding cho hộp vuông marker (px)
+            image: Ảnh gốc (hoặc một tầng của image pyramid)
+            coords: Tọa độ (x, y) của căn hộ trên ảnh gốc
+            zoom_size: Kích thước vùng zoom (px, theo ảnh gốc)
+            marker_size: Kích thước padding cho hộp vuông marker (px, theo ảnh gốc)
             image_type: Loại ảnh ("blueprint" hoặc "map") để điều chỉnh kích thước marker
+            scale: Hệ số thu nhỏ của `image` so với ảnh gốc (1 = ảnh gốc)
+            blend_mode: "roi" chỉ blend vùng marker, "full" blend qua bản copy toàn bộ crop
         """
-        x, y = coords
+        x, y = coords[0] // scale, coords[1] // scale
+        zoom_size = max(1, zoom_size // scale)
         h, w = image.shape[:2]
         
         # Điều chỉnh kích thước marker dựa trên loại ảnh
-        actual_marker_size = 90 if image_type == "blueprint" else marker_size
+        actual_marker_size = max(1, (90 if image_type == "blueprint" else marker_size) // scale)
         
         # Tính toán vùng crop
         half_size = zoom_size // 2
@@ -116,10 +1022,13 @@ class ApartmentSearcher:
         cropped = image[y1:y2, x1:x2].copy()
         
         # Tính tọa độ marker trong ảnh đã crop
-        marker_x = x - x1
-        marker_y = y - y1
+        self.draw_marker(cropped, x - x1, y - y1, actual_marker_size, blend_mode)
         
-        # Vẽ hộp vuông marker đỏ với padding
+        return cropped
+    
+    def marker_box(self, cropped: np.ndarray, marker_x: int, marker_y: int,
+                   actual_marker_size: int) -> Tuple[int, int, int, int]:
+        """Tọa độ (x1, y1, x2, y2) của hộp vuông marker, đã giới hạn trong ảnh crop"""
         # Tính toán tọa độ hộp vuông
         box_x1 = marker_x - actual_marker_size
         box_y1 = marker_y - actual_marker_size
@@ -131,28 +1040,153 @@ class ApartmentSearcher:
         box_y1 = max(0, box_y1)
         box_x2 = min(cropped.shape[1], box_x2)
         box_y2 = min(cropped.shape[0], box_y2)
-        
-        # Vẽ hộp vuông đỏ với độ trong suốt
-        overlay = cropped.copy()
-        cv2.rectangle(overlay, (box_x1, box_y1), (box_x2, box_y2), (0, 0, 255), -1)
-        # Blend với ảnh gốc để tạo hiệu ứng trong suốt
-        cv2.addWeighted(overlay, 0.3, cropped, 0.7, 0, cropped)
+        return box_x1, box_y1, box_x2, box_y2
+    
+    def draw_marker_outline(self, cropped: np.ndarray, box: Tuple[int, int, int, int]):
+        """Vẽ viền marker (đỏ đậm + viền đen bên ngoài)"""
+        box_x1, box_y1, box_x2, box_y2 = box
         
         # Vẽ viền đỏ đậm cho hộp vuông
         cv2.rectangle(cropped, (box_x1, box_y1), (box_x2, box_y2), (0, 0, 255), 3)
         
         # Vẽ viền đen bên ngoài để làm nổi bật
         cv2.rectangle(cropped, (box_x1-2, box_y1-2), (box_x2+2, box_y2+2), (0, 0, 0), 2)
+    
+    def draw_marker(self, cropped: np.ndarray, marker_x: int, marker_y: int, actual_marker_size: int,
+                    blend_mode: str = "roi"):
+        """Vẽ hộp vuông marker đỏ (trong suốt + viền) lên ảnh đã crop, ghi trực tiếp vào ảnh"""
+        # Vẽ hộp vuông marker đỏ với padding
+        box_x1, box_y1, box_x2, box_y2 = self.marker_box(cropped, marker_x, marker_y, actual_marker_size)
+        
+        # Vẽ hộp vuông đỏ với độ trong suốt
+        if blend_mode == "full":
+            overlay = cropped.copy()
+            cv2.rectangle(overlay, (box_x1, box_y1), (box_x2, box_y2), (0, 0, 255), -1)
+            # Blend với ảnh gốc để tạo hiệu ứng trong suốt
+            cv2.addWeighted(overlay, 0.3, cropped, 0.7, 0, cropped)
+        else:
+            # Chỉ blend vùng hộp vuông (cv2.rectangle tô cả cạnh x2/y2 nên +1),
+            # phần còn lại của crop giữ nguyên nên kết quả giống chế độ "full"
+            roi = cropped[box_y1:box_y2 + 1, box_x1:box_x2 + 1]
+            if roi.size:
+                cv2.addWeighted(marker_fill(roi.shape[0], roi.shape[1]), 0.3, roi, 0.7, 0, roi)
+        
+        self.draw_marker_outline(cropped, (box_x1, box_y1, box_x2, box_y2))
+    
+    def create_overview_image_with_markers(self, image: np.ndarray, coords_list: List[Tuple[int, int]],
+                                           padding: int = 200, marker_size: int = 30, image_type: str = "map",
+                                           scale: int = 1) -> np.ndarray:
+        """
+        Tạo một ảnh tổng quan chứa marker của nhiều căn hộ
+        
+        Crop theo bounding box của tất cả căn (cộng thêm padding), tô tất cả hộp
+        marker trên cùng một overlay rồi blend một lần để các hộp chồng nhau
+        không bị tô đậm hai lần.
+        
+        Args:
+            image: Ảnh gốc (hoặc một tầng của image pyramid)
+            coords_list: Danh sách tọa độ (x, y) trên ảnh gốc
+            padding: Khoảng cách (px, theo ảnh gốc) từ bounding box đến mép ảnh crop
+            marker_size: Kích thước padding cho hộp vuông marker (px, theo ảnh gốc)
+            image_type: Loại ảnh ("blueprint" hoặc "map") để điều chỉnh kích thước marker
+            scale: Hệ số thu nhỏ của `image` so với ảnh gốc (1 = ảnh gốc)
+        """
+        h, w = image.shape[:2]
+        points = [(x // scale, y // scale) for x, y in coords_list]
+        padding = padding // scale
+        actual_marker_size = max(1, (90 if image_type == "blueprint" else marker_size) // scale)
+        
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        x1 = max(0, min(xs) - padding)
+        y1 = max(0, min(ys) - padding)
+        x2 = min(w, max(xs) + padding + 1)
+        y2 = min(h, max(ys) + padding + 1)
+        
+        cropped = image[y1:y2, x1:x2].copy()
+        boxes = [self.marker_box(cropped, x - x1, y - y1, actual_marker_size) for x, y in points]
+        
+        overlay = cropped.copy()
+        for box_x1, box_y1, box_x2, box_y2 in boxes:
+            cv2.rectangle(overlay, (box_x1, box_y1), (box_x2, box_y2), (0, 0, 255), -1)
+        cv2.addWeighted(overlay, 0.3, cropped, 0.7, 0, cropped)
+        
+        for box in boxes:
+            self.draw_marker_outline(cropped, box)
         
         return cropped
     
-    def search_apartment(self, apartment_id: str, zoom_size: int = 400) -> Dict:
+    @staticmethod
+    def select_pyramid_level(pyramid: List[np.ndarray], zoom_size: int, max_output_dim: Optional[int] = None) -> int:
+        """
+        Chọn tầng pyramid thô nhất mà ảnh output vẫn không vượt quá max_output_dim
+
+        Tầng k có độ phân giải 1/2^k ảnh gốc; không giới hạn thì dùng ảnh gốc (tầng 0),
+        pyramid không đủ tầng thì dùng tầng thô nhất (ảnh được fit_to_max_dim sau khi crop).
+        """
+        if not max_output_dim:
+            return 0
+        level = 0
+        while zoom_size >> level > max_output_dim and level + 1 < len(pyramid):
+            level += 1
+        return level
+    
+    def render_apartment_image(self, apartment_id: str, image_type: str, coords: Tuple[int, int],
+                               zoom_size: int, max_output_dim: Optional[int] = None,
+                               encoding: Tuple = DEFAULT_ENCODING) -> Tuple[np.ndarray, bytes, int]:
+        """
+        Render ảnh zoom + encode (mặc định JPEG), dùng render_cache nếu đã có
+
+        Với max_output_dim, crop từ tầng pyramid phù hợp thay vì ảnh gốc. Với
+        encoding khác mặc định, ảnh đã render (JPEG mặc định) được encode lại
+        thay vì render lại; entry mới dùng chung mảng ảnh với entry mặc định.
+
+        Returns:
+            (ảnh đã render, bytes đã encode, tầng pyramid đã dùng)
+        """
+        with self._swap_lock:
+            pyramid = self.image_pyramids[image_type]
+            digest = self.image_digests[image_type]
+        # Chọn tầng theo đúng pyramid vừa lấy: reload có thể đổi số tầng
+        level = self.select_pyramid_level(pyramid, zoom_size, max_output_dim)
+        # Tầng thô nhất vẫn lớn hơn max_output_dim: resize thêm sau khi crop
+        fit_dim = max_output_dim if max_output_dim and zoom_size >> level > max_output_dim else None
+        # Key gồm tọa độ + hash ảnh nên entry cũ không bao giờ khớp sau khi reload data
+        base_key = (apartment_id, image_type, tuple(coords), zoom_size, level, fit_dim, digest)
+        key = base_key if encoding == DEFAULT_ENCODING else base_key + (encoding,)
+        cached = self.render_cache.get(key)
+        if cached is not None:
+            return cached + (level,)
+        
+        base = self.render_cache.get(base_key) if key != base_key else None
+        if base is None:
+            image = pyramid[level]
+            with stage("render"):
+                zoomed = fit_to_max_dim(self.create_zoomed_image_with_marker(
+                    image, coords, zoom_size, image_type=image_type, scale=1 << level
+                ), fit_dim)
+            with stage("encode"):
+                encoded = encode_image(zoomed)
+            self.render_cache.put(base_key, zoomed, encoded)
+            base = (zoomed, encoded)
+        if key == base_key:
+            return base + (level,)
+        
+        with stage("encode"):
+            encoded = encode_image(base[0], encoding)
+        self.render_cache.put(key, base[0], encoded)
+        return base[0], encoded, level
+    
+    def search_apartment(self, apartment_id: str, zoom_size: int = 400, max_output_dim: Optional[int] = None,
+                         encoding: Tuple = DEFAULT_ENCODING) -> Dict:
         """
         Tìm kiếm căn hộ và trả về ảnh đã zoom
         
         Args:
             apartment_id: ID căn hộ (VD: CH01, CH02)
             zoom_size: Kích thước vùng zoom
+            max_output_dim: Kích thước tối đa (px) của ảnh trả về, None = độ phân giải gốc
+            encoding: Định dạng / quality của ảnh encode (xem make_encoding)
         """
         # Chuẩn hóa apartment_id
         apartment_id = apartment_id.upper().strip()
@@ -166,7 +1200,10 @@ class ApartmentSearcher:
         result = {
             "apartment_id": apartment_id,
             "found_in": [],
-            "images": {}
+            "images": {},
+            "encoded": {},
+            "pyramid_levels": {},
+            "encoding": encoding
         }
         
         # Xử lý blueprint
@@ -174,33 +1211,359 @@ class ApartmentSearcher:
             result["found_in"].append("blueprint")
             result["blueprint_coords"] = {"x": blueprint_coords[0], "y": blueprint_coords[1]}
             
-            zoomed_blueprint = self.create_zoomed_image_with_marker(
-                self.blueprint_image, blueprint_coords, zoom_size, image_type="blueprint"
+            zoomed_blueprint, encoded_blueprint, level = self.render_apartment_image(
+                apartment_id, "blueprint", blueprint_coords, zoom_size, max_output_dim, encoding
             )
             result["images"]["blueprint"] = zoomed_blueprint
+            result["encoded"]["blueprint"] = encoded_blueprint
+            result["pyramid_levels"]["blueprint"] = level
         
         # Xử lý map
         if map_coords:
             result["found_in"].append("map")
             result["map_coords"] = {"x": map_coords[0], "y": map_coords[1]}
             
-            zoomed_map = self.create_zoomed_image_with_marker(
-                self.map_image, map_coords, zoom_size, image_type="map"
+            zoomed_map, encoded_map, level = self.render_apartment_image(
+                apartment_id, "map", map_coords, zoom_size, max_output_dim, encoding
             )
             result["images"]["map"] = zoomed_map
+            result["encoded"]["map"] = encoded_map
+            result["pyramid_levels"]["map"] = level
+        
+        return result
+    
+    def search_apartments_overview(self, apartment_ids: List[str], max_output_dim: Optional[int] = None,
+                                   padding: int = OVERVIEW_PADDING) -> Dict:
+        """
+        Render một ảnh tổng quan mỗi layer với marker cho tất cả căn trong danh sách
+        
+        Căn không có tọa độ trên một layer sẽ bị bỏ qua ở layer đó.
+        
+        Returns:
+            Dict giống search_apartment, thêm "overview_key" định danh bộ căn
+        """
+        apartment_ids = sorted(dict.fromkeys(a.upper().strip() for a in apartment_ids))
+        overview_key = hashlib.sha256(",".join(apartment_ids).encode("utf-8")).hexdigest()[:16]
+        coords = self.coord_catalog.get_many(apartment_ids)
+        
+        result = {
+            "apartment_ids": apartment_ids,
+            "overview_key": overview_key,
+            "found_in": [],
+            "images": {},
+            "encoded": {},
+            "pyramid_levels": {}
+        }
+        
+        for image_type in ("blueprint", "map"):
+            layer_coords = coords[image_type]
+            present = layer_coords[:, 0] != ApartmentCoordCatalog.MISSING
+            if not present.any():
+                continue
+            points = [(int(x), int(y)) for x, y in layer_coords[present]]
+            
+            xs = [x for x, _ in points]
+            ys = [y for _, y in points]
+            bbox_size = max(max(xs) - min(xs), max(ys) - min(ys)) + 2 * padding
+            with self._swap_lock:
+                pyramid = self.image_pyramids[image_type]
+                digest = self.image_digests[image_type]
+            level = self.select_pyramid_level(pyramid, bbox_size, max_output_dim)
+            # Bounding box sau khi chia scale có thể lệch vài px so với bbox_size >> level
+            fit_dim = max_output_dim
+            key = ("overview", overview_key, image_type, hash(tuple(points)), padding, level, fit_dim, digest)
+            cached = self.render_cache.get(key)
+            if cached is None:
+                with stage("render_overview"):
+                    rendered = fit_to_max_dim(self.create_overview_image_with_markers(
+                        pyramid[level], points, padding,
+                        image_type=image_type, scale=1 << level
+                    ), fit_dim)
+                with stage("encode"):
+                    cached = (rendered, encode_image(rendered))
+                self.render_cache.put(key, *cached)
+            
+            result["found_in"].append(image_type)
+            result["images"][image_type] = cached[0]
+            result["encoded"][image_type] = cached[1]
+            result["pyramid_levels"][image_type] = level
         
         return result
 
 # Khởi tạo searcher
 searcher = None
+_searcher_lock = threading.Lock()
 
 def get_searcher():
     """Lazy initialization của searcher"""
     global searcher
     if searcher is None:
-        searcher = ApartmentSearcher()
+        # Warm-up và request đầu tiên có thể gọi cùng lúc từ nhiều thread
+        with _searcher_lock:
+            if searcher is None:
+                searcher = ApartmentSearcher()
     return searcher
 
+class DataWatcher:
+    """
+    Thread nền kiểm tra file dữ liệu mỗi `interval` giây và reload khi có thay đổi
+
+    Chỉ kiểm tra khi searcher đã được load (không ép load data sớm).
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="data-watcher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if searcher is not None:
+                searcher.check_for_updates()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval)
+
+class RenderQueueFull(Exception):
+    """Hàng đợi render đã đầy, request nên bị từ chối (503)"""
+
+
+class RenderExecutor:
+    """
+    Executor chạy render OpenCV + encode JPEG ngoài event loop
+
+    kind="thread" dùng chung searcher và render_cache của process hiện tại
+    (OpenCV nhả GIL khi xử lý ảnh). kind="process" chạy job trong process con,
+    mỗi process con tự load searcher riêng. Số job chờ + đang chạy bị giới hạn
+    bởi max_queue; vượt quá thì raise RenderQueueFull.
+    """
+
+    def __init__(self, kind: str = "thread", max_workers: Optional[int] = None, max_queue: int = 64):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"RENDER_EXECUTOR không hợp lệ: {kind}")
+        self.kind = kind
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self._executor = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="render")
+        return self._executor
+
+    def _timed(self, submitted_at: float, fn, *args):
+        started_at = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.total_wait_seconds += started_at - submitted_at
+                self.total_run_seconds += time.perf_counter() - started_at
+
+    async def run(self, fn, *args):
+        """Chạy fn(*args) trong pool và await kết quả"""
+        with self._lock:
+            if self.in_flight >= self.max_queue:
+                self.rejected += 1
+                raise RenderQueueFull(f"Hàng đợi render đầy ({self.max_queue} job)")
+            self.in_flight += 1
+            self.submitted += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        
+        loop = asyncio.get_running_loop()
+        try:
+            if self.kind == "process":
+                # Không đo được thời gian chờ trong process con, gộp vào run time
+                started_at = time.perf_counter()
+                result = await loop.run_in_executor(self._get_executor(), fn, *args)
+                with self._lock:
+                    self.total_run_seconds += time.perf_counter() - started_at
+            else:
+                # Chạy trong context của request để stage() ghi được vào Server-Timing
+                result = await loop.run_in_executor(
+                    self._get_executor(), contextvars.copy_context().run,
+                    self._timed, time.perf_counter(), fn, *args
+                )
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        
+        with self._lock:
+            self.completed += 1
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            finished = self.completed + self.failed
+            return {
+                "kind": self.kind,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "submitted": self.submitted,
+                "completed": self.completed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "avg_wait_ms": self.total_wait_seconds * 1000 / finished if finished else 0.0,
+                "avg_run_ms": self.total_run_seconds * 1000 / finished if finished else 0.0
+            }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+render_executor = RenderExecutor(
+    kind=os.getenv("RENDER_EXECUTOR", "thread"),
+    max_workers=int(os.getenv("RENDER_WORKERS", 0)) or None,
+    max_queue=int(os.getenv("RENDER_MAX_QUEUE", 64))
+)
+
+class SingleFlight:
+    """
+    Gộp các lời gọi async đồng thời có cùng key thành một lần thực thi
+
+    Lời gọi đầu tiên (leader) chạy fn trong một task riêng; các lời gọi cùng key
+    đến khi task chưa xong (follower) chỉ await kết quả của task đó, kể cả
+    exception. Task được shield nên client của leader ngắt kết nối cũng không
+    hủy công việc mà follower đang chờ. Key bị xóa ngay khi task xong, nên
+    đây không phải cache.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._tasks = {}
+
+    def in_flight(self, key) -> Optional[asyncio.Task]:
+        return self._tasks.get(key)
+
+    async def do(self, key, fn, *args):
+        task = self._tasks.get(key)
+        if task is None:
+            metrics.inc("apartment_singleflight_calls_total", group=self.name, role="leader")
+            task = asyncio.ensure_future(fn(*args))
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            metrics.inc("apartment_singleflight_calls_total", group=self.name, role="follower")
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task: asyncio.Task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Đánh dấu exception đã được lấy (tránh cảnh báo khi mọi caller đã bị hủy)
+            task.exception()
+
+# Single-flight cho render (theo căn/bộ căn + zoom + encoding), upload (theo public_id + nội dung) và câu trả lời AI
+render_flight = SingleFlight("render")
+upload_flight = SingleFlight("upload")
+llm_flight = SingleFlight("llm")
+
+def _searcher_job(method: str, *args) -> Tuple:
+    """
+    Job render cho process pool: gọi get_searcher().<method>(*args) trong process con.
+    HTTPException không pickle được nên được trả về dạng tuple thay vì raise
+    qua ranh giới process. Phần tử cuối là danh sách (stage, giây) để process
+    cha ghi vào metric của nó.
+    """
+    timings = []
+    _request_timings.set(timings)
+    worker_searcher = get_searcher()
+    if DATA_WATCH_INTERVAL > 0:
+        # Process con không có DataWatcher riêng, kiểm tra file theo chu kỳ khi nhận job
+        worker_searcher.check_for_updates(min_interval=DATA_WATCH_INTERVAL)
+    try:
+        result = getattr(worker_searcher, method)(*args)
+    except HTTPException as e:
+        return ("error", e.status_code, e.detail, timings)
+    # Ảnh thô không cần ở process cha (chỉ dùng bytes đã encode), bỏ để giảm pickle
+    result["images"] = {}
+    return ("ok", result, timings)
+
+async def run_searcher_method(searcher: "ApartmentSearcher", method: str, *args) -> Dict:
+    """
+    Gọi searcher.<method>(*args) qua render_executor, không block event loop
+
+    Các lời gọi đồng thời cùng method + tham số dùng chung một job render.
+    """
+    key = (method,) + tuple(tuple(arg) if isinstance(arg, list) else arg for arg in args)
+    return await render_flight.do(key, _run_searcher_method, searcher, method, *args)
+
+async def _run_searcher_method(searcher: "ApartmentSearcher", method: str, *args) -> Dict:
+    try:
+        if render_executor.kind == "process":
+            outcome = await render_executor.run(_searcher_job, method, *args)
+            for name, seconds in outcome[-1]:
+                record_stage(name, seconds)
+            if outcome[0] == "error":
+                raise HTTPException(status_code=outcome[1], detail=outcome[2])
+            return outcome[1]
+        return await render_executor.run(getattr(searcher, method), *args)
+    except RenderQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "1"})
+
+async def run_search(searcher: "ApartmentSearcher", apartment_id: str, zoom_size: int,
+                     max_output_dim: Optional[int] = None, encoding: Tuple = DEFAULT_ENCODING) -> Dict:
+    """Gọi searcher.search_apartment qua render_executor"""
+    return await run_searcher_method(
+        searcher, "search_apartment", apartment_id.upper().strip(), zoom_size, max_output_dim, encoding
+    )
+
+# HTTP caching: kết quả chỉ đổi khi data/ hoặc images/ đổi, nên ETag = hash(data_version + tham số)
+HTTP_CACHE_MAX_AGE = int(os.getenv("HTTP_CACHE_MAX_AGE", 300))
+
+def make_etag(data_version: str, *params) -> str:
+    """Strong ETag từ version dữ liệu + tham số request đã chuẩn hóa"""
+    payload = json.dumps([data_version, *params], ensure_ascii=False, default=str)
+    return '"' + hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32] + '"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    If-None-Match có chứa etag (hoặc "*") không; so sánh weak theo RFC 9110
+
+    Chỉ gọi sau khi đã biết response sẽ là 200: "*" nghĩa là tài nguyên tồn tại,
+    nên không được trả 304 cho tài nguyên sẽ 404.
+    """
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    candidates = [c.strip() for c in header.split(",")]
+    return "*" in candidates or any(c.removeprefix("W/") == etag for c in candidates)
+
+def cache_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": f"public, max-age={HTTP_CACHE_MAX_AGE}"}
+
+def not_modified(etag: str) -> Response:
+    """304 không body, giữ ETag + Cache-Control để client / CDN gia hạn cache"""
+    return Response(status_code=304, headers=cache_headers(etag))
+
+def cacheable_json(content: Dict, etag: str) -> JSONResponse:
+    return JSONResponse(content=content, headers=cache_headers(etag))
+
 @app.get("/")
 async def root():
     """Trang chủ API"""
@@ -209,125 +1572,889 @@ async def root():
         "version": "1.0.0",
         "endpoints": {
             "/search": "Tìm kiếm căn hộ",
+            "/search/batch": "Tìm kiếm nhiều căn hộ cùng lúc",
+            "/images/{key}": "Ảnh đã render (IMAGE_STORAGE=local hoặc upload nền)",
+            "/uploads/{job_id}": "Trạng thái job upload nền của /search",
             "/apartments": "Danh sách tất cả căn hộ",
+            "/apartments/query": "Lọc căn hộ theo phân khu, tầng, giá, diện tích",
+            "/locate": "Tìm căn hộ tại điểm click trên blueprint / map",
+            "/viewport": "Các căn hộ trong một vùng của blueprint / map",
+            "/chat": "Chat với AI",
+            "/chat/stream": "Chat với AI (streaming SSE)",
+            "/metrics": "Metric Prometheus (latency theo stage, cache, lỗi)",
             "/docs": "Swagger documentation"
         }
     }
 
 @app.get("/apartments")
-async def get_all_apartments():
+async def get_all_apartments(request: Request):
     """Lấy danh sách tất cả căn hộ có sẵn"""
     searcher = get_searcher()
-    blueprint_apartments = set(searcher.blueprint_data['Apartment'].tolist())
-    map_apartments = set(searcher.map_data['Apartment'].tolist())
-    all_apartments = sorted(blueprint_apartments.union(map_apartments))
+    etag = make_etag(searcher.data_version, "apartments")
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    return cacheable_json(searcher.apartments_summary(), etag)
+
+@app.get("/apartments/query")
+async def query_apartments(
+    zone: Optional[str] = Query(None, description="Phân khu (VD: Origami)"),
+    floor: Optional[int] = Query(None, description="Tầng"),
+    corner: Optional[bool] = Query(None, description="Chỉ căn góc (true) / không góc (false)"),
+    apartment_number: Optional[int] = Query(None, description="Số căn (Căn STT)"),
+    unit_type: Optional[str] = Query(None, description="Loại hình (VD: 2PN + 1)"),
+    price_min: Optional[float] = Query(None, description="Giá tối thiểu (VNĐ)"),
+    price_max: Optional[float] = Query(None, description="Giá tối đa (VNĐ)"),
+    area_min: Optional[float] = Query(None, description="Diện tích tim tường tối thiểu (m²)"),
+    area_max: Optional[float] = Query(None, description="Diện tích tim tường tối đa (m²)"),
+    net_area_min: Optional[float] = Query(None, description="Diện tích thông thủy tối thiểu (m²)"),
+    net_area_max: Optional[float] = Query(None, description="Diện tích thông thủy tối đa (m²)"),
+    sort_by: Optional[str] = Query(None, description="price, area, net_area, floor hoặc apartment_number"),
+    order: str = Query("asc", description="asc hoặc desc"),
+    limit: Optional[int] = Query(None, description="Số kết quả tối đa", ge=1, le=10000)
+):
+    """
+    🔎 Lọc căn hộ trong sheet theo điều kiện có cấu trúc (lọc bằng, lọc khoảng, sắp xếp)
+    """
+    searcher = get_searcher()
+    filters = {
+        column: value for column, value in (
+            ("PHÂN KHU", zone), ("Tầng", floor), ("căn góc", corner),
+            ("Căn STT", apartment_number), ("Loại hình", unit_type)
+        ) if value is not None
+    }
+    ranges = {
+        name: bounds for name, bounds in (
+            ("price", (price_min, price_max)),
+            ("area", (area_min, area_max)),
+            ("net_area", (net_area_min, net_area_max))
+        ) if bounds != (None, None)
+    }
+    if order not in ("asc", "desc"):
+        raise HTTPException(status_code=400, detail="order phải là asc hoặc desc")
+    
+    try:
+        apartments = searcher.filter_index.query(
+            filters=filters, ranges=ranges, sort_by=sort_by, descending=order == "desc", limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
-        "total": len(all_apartments),
-        "apartments": all_apartments,
-        "blueprint_only": sorted(blueprint_apartments - map_apartments),
-        "map_only": sorted(map_apartments - blueprint_apartments),
-        "both": sorted(blueprint_apartments.intersection(map_apartments))
+        "total": len(apartments),
+        "apartments": apartments
     }
 
-def image_to_base64(image: np.ndarray) -> str:
-    """Chuyển đổi OpenCV image sang base64 string"""
-    _, buffer = cv2.imencode('.jpg', image)
-    img_base64 = base64.b64encode(buffer).decode('utf-8')
-    return img_base64
+LOCATE_MAX_RADIUS = 5000
+
+def spatial_index_for(searcher: "ApartmentSearcher", layer: str) -> SpatialGrid:
+    if layer not in ("blueprint", "map"):
+        raise HTTPException(status_code=400, detail="layer phải là blueprint hoặc map")
+    return searcher.spatial_index[layer]
+
+@app.get("/locate")
+async def locate_apartment(
+    request: Request,
+    layer: str = Query(..., description="Layer: blueprint hoặc map"),
+    x: float = Query(..., description="Tọa độ x (px) trên ảnh gốc của layer"),
+    y: float = Query(..., description="Tọa độ y (px) trên ảnh gốc của layer"),
+    radius: float = Query(50, description="Khoảng cách tối đa (px) tới tâm marker", ge=0, le=LOCATE_MAX_RADIUS)
+):
+    """
+    📍 Tìm căn hộ tại điểm click (x, y) trên blueprint hoặc map
+
+    Trả về căn có tâm marker gần điểm click nhất trong bán kính radius, 404 nếu
+    không có căn nào.
+    """
+    searcher = get_searcher()
+    index = spatial_index_for(searcher, layer)
+    found = index.nearest(x, y, radius)
+    if found is None:
+        raise HTTPException(status_code=404, detail=f"Không có căn hộ nào trong bán kính {radius:g}px quanh ({x:g}, {y:g})")
+    etag = make_etag(searcher.data_version, "locate", layer, x, y, radius)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    apartment_id, (apartment_x, apartment_y), distance = found
+    return cacheable_json({
+        "success": True,
+        "data": {
+            "layer": layer,
+            "apartment_id": apartment_id,
+            "coordinates": {"x": apartment_x, "y": apartment_y},
+            "distance": round(distance, 2)
+        }
+    }, etag)
+
+@app.get("/viewport")
+async def viewport_apartments(
+    request: Request,
+    layer: str = Query(..., description="Layer: blueprint hoặc map"),
+    x_min: float = Query(..., description="Cạnh trái viewport (px)"),
+    y_min: float = Query(..., description="Cạnh trên viewport (px)"),
+    x_max: float = Query(..., description="Cạnh phải viewport (px)"),
+    y_max: float = Query(..., description="Cạnh dưới viewport (px)"),
+    limit: Optional[int] = Query(None, description="Số căn tối đa", ge=1, le=10000)
+):
+    """
+    🗺️ Tất cả căn hộ có tâm marker nằm trong viewport trên blueprint hoặc map
+
+    Kết quả sắp theo (y, x), tọa độ tính trên ảnh gốc của layer.
+    """
+    if x_min > x_max or y_min > y_max:
+        raise HTTPException(status_code=400, detail="Viewport không hợp lệ: cần x_min <= x_max và y_min <= y_max")
+    searcher = get_searcher()
+    index = spatial_index_for(searcher, layer)
+    etag = make_etag(searcher.data_version, "viewport", layer, x_min, y_min, x_max, y_max, limit)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+    
+    apartments = index.within(x_min, y_min, x_max, y_max, limit)
+    return cacheable_json({
+        "success": True,
+        "data": {
+            "layer": layer,
+            "viewport": {"x_min": x_min, "y_min": y_min, "x_max": x_max, "y_max": y_max},
+            "total": len(apartments),
+            "apartments": [
+                {"apartment_id": apartment_id, "x": apartment_x, "y": apartment_y}
+                for apartment_id, (apartment_x, apartment_y) in apartments
+            ]
+        }
+    }, etag)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+
+def open_sqlite(path: str, schema: str) -> sqlite3.Connection:
+    """Mở file SQLite dùng chung giữa các worker (WAL mode) và tạo bảng nếu chưa có"""
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(schema)
+    conn.commit()
+    return conn
+
+
+class UploadCache:
+    """
+    Cache persistent (SQLite) ánh xạ nội dung ảnh + public_id -> secure_url
+
+    File SQLite dùng chung giữa các worker (WAL mode) và giữ nguyên qua restart,
+    nên ảnh render giống hệt nhau không bao giờ bị upload lại.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_sqlite(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "content_hash TEXT NOT NULL, public_id TEXT NOT NULL, url TEXT NOT NULL, "
+                "created_at REAL NOT NULL DEFAULT (julianday('now')), "
+                "PRIMARY KEY (content_hash, public_id))"
+            )
+        return self._conn
+
+    @staticmethod
+    def content_hash(image_bytes: bytes) -> str:
+        return hashlib.sha256(image_bytes).hexdigest()
+
+    def get(self, content_hash: str, public_id: str) -> Optional[str]:
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    "SELECT url FROM uploads WHERE content_hash = ? AND public_id = ?",
+                    (content_hash, public_id)
+                ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            print(f"⚠️ Upload cache lỗi đọc: {e}")
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0]
+
+    def put(self, content_hash: str, public_id: str, url: str):
+        try:
+            with self._lock:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO uploads (content_hash, public_id, url) VALUES (?, ?, ?)",
+                    (content_hash, public_id, url)
+                )
+                conn.commit()
+        except (sqlite3.Error, OSError) as e:
+            print(f"⚠️ Upload cache lỗi ghi: {e}")
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "path": self.path,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+upload_cache = UploadCache(os.getenv("UPLOAD_CACHE_PATH", os.path.join(CACHE_DIR, "upload_cache.sqlite3")))
+
+class LocalImageStore:
+    """
+    Lưu ảnh đã render vào thư mục theo địa chỉ nội dung, thay cho Cloudinary
+
+    Key là "<sha256 của bytes>.<đuôi>", file nằm ở <directory>/<2 ký tự đầu>/<key>.
+    Nội dung không bao giờ đổi với cùng key nên ghi một lần (atomic qua
+    os.replace) và client / CDN được cache vĩnh viễn.
+    """
+
+    KEY_PATTERN = re.compile(r"^[0-9a-f]{64}\.(jpg|webp|png)$")
+
+    def __init__(self, directory: str, base_url: str = ""):
+        self.directory = directory
+        self.base_url = base_url.rstrip("/")
+        self.writes = 0
+
+    def path(self, key: str) -> Optional[str]:
+        """Đường dẫn file của key, None nếu key không hợp lệ (chặn path traversal)"""
+        if not self.KEY_PATTERN.match(key):
+            return None
+        return os.path.join(self.directory, key[:2], key)
+
+    def put(self, image_bytes: bytes, image_format: str = "jpeg") -> str:
+        """Ghi ảnh (nếu chưa có) và trả về URL phục vụ qua /images/{key}"""
+        key = hashlib.sha256(image_bytes).hexdigest() + IMAGE_FORMATS[image_format][0]
+        path = self.path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(image_bytes)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.writes += 1
+        return f"{self.base_url}/images/{key}"
+
+# IMAGE_STORAGE=local: ảnh được phục vụ từ /images/{key}, JSON path không cần gọi mạng ra ngoài
+IMAGE_STORAGE = os.getenv("IMAGE_STORAGE", "cloudinary").lower()
+local_image_store = LocalImageStore(
+    os.getenv("LOCAL_IMAGE_DIR", os.path.join(CACHE_DIR, "images")),
+    base_url=os.getenv("IMAGE_BASE_URL", "")
+)
+
+CLOUDINARY_UPLOAD_URL = os.getenv("CLOUDINARY_UPLOAD_URL", "https://api.cloudinary.com/v1_1/farmcode/image/upload")
+UPLOAD_TIMEOUT = float(os.getenv("UPLOAD_TIMEOUT", 30))
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", 8))
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", 2))
+
+def cloudinary_public_id(apartment_id: str, image_type: str, zoom_size: int, level: int = 0,
+                         encoding: Tuple = DEFAULT_ENCODING) -> str:
+    """public_id cố định cho mỗi (căn, layer, zoom, tầng pyramid, encoding)"""
+    public_id = f'apartment_{apartment_id}_{image_type}_zoom{zoom_size}'
+    if level:
+        public_id += f'_l{level}'
+    return public_id + encoding_suffix(encoding)
+
+def base64_data_uri(image_bytes: bytes, mime_type: str = "image/jpeg") -> str:
+    """Fallback khi upload thất bại: nhúng ảnh trực tiếp dạng data URI"""
+    return f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
+
+# Connection pool dùng chung cho upload bất đồng bộ (keep-alive giữa các request)
+_http_client: Optional[httpx.AsyncClient] = None
+_upload_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Lazy initialization của httpx.AsyncClient dùng chung"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=UPLOAD_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=UPLOAD_CONCURRENCY * 2,
+                max_keepalive_connections=UPLOAD_CONCURRENCY
+            )
+        )
+    return _http_client
+
+def get_upload_semaphore() -> asyncio.Semaphore:
+    """Giới hạn số upload chạy song song"""
+    global _upload_semaphore
+    if _upload_semaphore is None:
+        _upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    return _upload_semaphore
+
+async def close_http_client():
+    """Đóng connection pool khi app shutdown"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+async def upload_to_cloudinary_async(image_bytes: bytes, apartment_id: str, image_type: str,
+                                     zoom_size: int, level: int = 0, encoding: Tuple = DEFAULT_ENCODING) -> str:
+    """Upload ảnh của một layer với public_id theo (căn, layer, zoom, tầng pyramid, encoding)"""
+    return await upload_bytes_async(
+        image_bytes, cloudinary_public_id(apartment_id, image_type, zoom_size, level, encoding), encoding[0]
+    )
+
+async def upload_bytes_async(image_bytes: bytes, public_id: str, image_format: str = "jpeg") -> str:
+    """
+    Upload ảnh đã encode (image_format: jpeg/webp/png) lên Cloudinary với public_id cho trước
+    
+    Dùng connection pool chung, giới hạn song song bằng semaphore và retry với
+    backoff khi gặp lỗi mạng / 429 / 5xx. Thất bại hẳn thì fallback base64.
+    Với IMAGE_STORAGE=local, ảnh được ghi vào local_image_store thay vì upload.
+    """
+    if IMAGE_STORAGE == "local":
+        with stage("store"):
+            return await asyncio.to_thread(local_image_store.put, image_bytes, image_format)
+    
+    content_hash = upload_cache.content_hash(image_bytes)
+    # Đọc SQLite ngoài event loop (có thể chờ lock khi worker khác đang ghi)
+    cached_url = await asyncio.to_thread(upload_cache.get, content_hash, public_id)
+    if cached_url:
+        return cached_url
+    
+    # Cùng ảnh + public_id đang được upload bởi request khác: chờ kết quả, không upload lần nữa
+    return await upload_flight.do(
+        (public_id, content_hash), _upload_uncached, image_bytes, public_id, content_hash, image_format
+    )
+
+async def _upload_uncached(image_bytes: bytes, public_id: str, content_hash: str, image_format: str) -> str:
+    data = {
+        'upload_preset': 'portal',
+        'folder': 'other',
+        'public_id': public_id
+    }
+    extension, mime_type = IMAGE_FORMATS[image_format]
+    client = get_http_client()
+    
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            async with get_upload_semaphore():
+                with in_flight("upload"), stage("upload"):
+                    response = await client.post(
+                        CLOUDINARY_UPLOAD_URL,
+                        files={'file': (f'apartment{extension}', image_bytes, mime_type)},
+                        data=data
+                    )
+            
+            if response.status_code == 200:
+                result = response.json()
+                url = result.get('secure_url', result.get('url'))
+                if url:
+                    await asyncio.to_thread(upload_cache.put, content_hash, public_id, url)
+                return url
+            
+            print(f"❌ Cloudinary upload failed: {response.status_code} - {response.text}")
+            metrics.inc("apartment_upload_errors_total", reason=f"http_{response.status_code // 100}xx")
+            if response.status_code != 429 and response.status_code < 500:
+                # Lỗi phía client (4xx) thì retry cũng vô ích
+                break
+        except httpx.HTTPError as e:
+            print(f"❌ Lỗi upload Cloudinary (lần {attempt + 1}): {e}")
+            metrics.inc("apartment_upload_errors_total", reason="network")
+        
+        if attempt < UPLOAD_RETRIES:
+            await asyncio.sleep(0.5 * 2 ** attempt)
+    
+    metrics.inc("apartment_upload_fallbacks_total")
+    return base64_data_uri(image_bytes, mime_type)
+
+async def upload_images(encoded_images: Dict[str, bytes], apartment_id: str, zoom_size: int,
+                        levels: Optional[Dict[str, int]] = None,
+                        encoding: Tuple = DEFAULT_ENCODING) -> Dict[str, str]:
+    """Upload đồng thời tất cả layer (blueprint, map) của một căn"""
+    image_types = list(encoded_images.keys())
+    levels = levels or {}
+    urls = await asyncio.gather(*(
+        upload_to_cloudinary_async(
+            encoded_images[img_type], apartment_id, img_type, zoom_size, levels.get(img_type, 0), encoding
+        )
+        for img_type in image_types
+    ))
+    return dict(zip(image_types, urls))
+
+async def upload_overview_images(overview: Dict) -> Dict[str, str]:
+    """Upload đồng thời ảnh tổng quan (kết quả search_apartments_overview) của mỗi layer"""
+    image_types = list(overview["encoded"].keys())
+    urls = await asyncio.gather(*(
+        upload_bytes_async(
+            overview["encoded"][img_type],
+            f'apartment_overview_{overview["overview_key"]}_{img_type}_l{overview["pyramid_levels"][img_type]}'
+        )
+        for img_type in image_types
+    ))
+    return dict(zip(image_types, urls))
+
+# Upload nền: /search?upload=background trả về ngay, worker upload lên Cloudinary sau
+UPLOAD_MODE = os.getenv("UPLOAD_MODE", "sync").lower()
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 2))
+UPLOAD_QUEUE_SIZE = int(os.getenv("UPLOAD_QUEUE_SIZE", 256))
+UPLOAD_JOB_RETRIES = int(os.getenv("UPLOAD_JOB_RETRIES", 3))
+UPLOAD_JOB_TTL = float(os.getenv("UPLOAD_JOB_TTL", 3600))
+
+class UploadQueue:
+    """
+    Hàng đợi upload Cloudinary chạy nền cho /search (upload=background)
+
+    /search ghi ảnh vào local_image_store, trả về ngay URL /images/{key} kèm
+    job ID; `workers` task nền upload lên Cloudinary qua upload_bytes_async
+    (upload cache, single-flight, retry) và client poll GET /uploads/{job_id}
+    để lấy secure_url. Layer upload lỗi được đưa lại hàng đợi với backoff, tối
+    đa `retries` lần. Trạng thái job nằm trong bộ nhớ của process và được giữ
+    `ttl` giây sau khi xong.
+    """
+
+    def __init__(self, workers: int, max_size: int, retries: int, ttl: float):
+        self.workers = workers
+        self.max_size = max_size
+        self.retries = retries
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        self._payloads = {}
+        self._pending = {}
+        self._queue = None
+        self._tasks = []
+
+    def start(self):
+        """Tạo hàng đợi + worker trong event loop hiện tại (gọi từ lifespan)"""
+        self._queue = asyncio.Queue(self.max_size)
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, items: Dict[str, Tuple[bytes, str, str, str]], images_urls: Dict[str, str]) -> Dict:
+        """
+        Tạo job upload cho items (layer -> (bytes, public_id, image_format, content_hash))
+
+        images_urls là URL dùng tạm (local) cho tới khi upload xong. Cùng nội dung
+        đang có job chưa xong thì trả về job đó. Gọi full() trước để tránh QueueFull.
+        """
+        self._purge_expired()
+        key = tuple(sorted((public_id, content_hash) for _, public_id, _, content_hash in items.values()))
+        job_id = self._pending.get(key)
+        if job_id is not None:
+            return self.jobs[job_id]
+        
+        job_id = os.urandom(12).hex()
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "images_urls": dict(images_urls),
+            "attempts": 0,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None
+        }
+        self.jobs[job_id] = job
+        self._payloads[job_id] = (key, dict(items))
+        self._pending[key] = job_id
+        self._queue.put_nowait(job_id)
+        metrics.inc("apartment_upload_jobs_total", status="queued")
+        return job
+
+    def full(self) -> bool:
+        """Hàng đợi đầy hoặc worker chưa chạy (ngoài lifespan)"""
+        return self._queue is None or self._queue.full()
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        self._purge_expired()
+        return self.jobs.get(job_id)
+
+    async def _run(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._process(job_id)
+            except Exception as e:
+                print(f"❌ Lỗi upload job {job_id}: {e}")
+                self._finish(job_id, "failed", str(e))
+            finally:
+                self._queue.task_done()
+
+    async def _process(self, job_id: str):
+        job = self.jobs[job_id]
+        key, items = self._payloads[job_id]
+        job["status"] = "running"
+        job["attempts"] += 1
+        
+        urls = await asyncio.gather(*(
+            upload_bytes_async(image_bytes, public_id, image_format)
+            for image_bytes, public_id, image_format, _ in items.values()
+        ), return_exceptions=True)
+        failed = {}
+        for img_type, url in zip(list(items), urls):
+            if isinstance(url, str) and url and not url.startswith("data:"):
+                job["images_urls"][img_type] = url
+            else:
+                failed[img_type] = items[img_type]
+        
+        if not failed:
+            self._finish(job_id, "done")
+        elif job["attempts"] > self.retries:
+            self._finish(job_id, "failed", f"Upload thất bại sau {job['attempts']} lần: {', '.join(failed)}")
+        else:
+            # Chỉ upload lại các layer lỗi, sau backoff (không chiếm worker trong lúc chờ)
+            self._payloads[job_id] = (key, failed)
+            job["status"] = "queued"
+            asyncio.get_running_loop().call_later(2 ** job["attempts"], self._requeue, job_id)
+
+    def _requeue(self, job_id: str):
+        if self._queue is None:
+            return
+        try:
+            self._queue.put_nowait(job_id)
+        except asyncio.QueueFull:
+            self._finish(job_id, "failed", "Hàng đợi upload đầy")
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None):
+        job = self.jobs[job_id]
+        job["status"] = status
+        job["error"] = error
+        job["finished_at"] = time.time()
+        key, _ = self._payloads.pop(job_id)
+        self._pending.pop(key, None)
+        metrics.inc("apartment_upload_jobs_total", status=status)
+
+    def _purge_expired(self):
+        # jobs theo thứ tự tạo: xóa job đã xong quá ttl ở đầu danh sách
+        now = time.time()
+        while self.jobs:
+            job = next(iter(self.jobs.values()))
+            if job["finished_at"] is None or now - job["finished_at"] < self.ttl:
+                break
+            self.jobs.popitem(last=False)
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "pending": len(self._pending),
+            "jobs": len(self.jobs)
+        }
+
+upload_queue = UploadQueue(UPLOAD_WORKERS, UPLOAD_QUEUE_SIZE, UPLOAD_JOB_RETRIES, UPLOAD_JOB_TTL)
+
+async def enqueue_upload_images(encoded_images: Dict[str, bytes], apartment_id: str, zoom_size: int,
+                                levels: Optional[Dict[str, int]] = None,
+                                encoding: Tuple = DEFAULT_ENCODING) -> Tuple[Dict[str, str], Optional[Dict]]:
+    """
+    Phiên bản không chờ của upload_images
+
+    Layer đã có trong upload cache dùng luôn secure_url; layer còn lại được ghi
+    vào local_image_store (URL /images/{key} dùng được ngay) và đưa vào
+    upload_queue. Trả về (images_urls, job), job là None nếu không cần upload.
+    Hàng đợi đầy thì upload đồng bộ như upload_images (backpressure).
+    """
+    levels = levels or {}
+    images_urls = {}
+    items = {}
+    for img_type, image_bytes in encoded_images.items():
+        public_id = cloudinary_public_id(apartment_id, img_type, zoom_size, levels.get(img_type, 0), encoding)
+        content_hash = upload_cache.content_hash(image_bytes)
+        cached_url = await asyncio.to_thread(upload_cache.get, content_hash, public_id)
+        if cached_url:
+            images_urls[img_type] = cached_url
+        else:
+            items[img_type] = (image_bytes, public_id, encoding[0], content_hash)
+    if not items:
+        return images_urls, None
+    if upload_queue.full():
+        metrics.inc("apartment_upload_jobs_total", status="rejected")
+        uploaded = await asyncio.gather(*(
+            upload_bytes_async(image_bytes, public_id, image_format)
+            for image_bytes, public_id, image_format, _ in items.values()
+        ))
+        images_urls.update(zip(items, uploaded))
+        return images_urls, None
+    
+    with stage("store"):
+        local_urls = await asyncio.to_thread(
+            lambda: {img_type: local_image_store.put(item[0], item[2]) for img_type, item in items.items()}
+        )
+    images_urls.update(local_urls)
+    return images_urls, upload_queue.submit(items, images_urls)
+
+def upload_job_view(job: Dict) -> Dict:
+    """Thông tin job trả về cho client (kèm URL để poll)"""
+    return {**job, "poll_url": f"/uploads/{job['job_id']}"}
+
+def multipart_response(parts: Dict[str, bytes], mime_type: str, filename_prefix: str,
+                       headers: Optional[Dict[str, str]] = None) -> Response:
+    """Gói nhiều ảnh vào một response multipart/mixed, mỗi part một layer"""
+    boundary = f"apartment-{os.urandom(8).hex()}"
+    extension = next(ext for ext, mime in IMAGE_FORMATS.values() if mime == mime_type)
+    body = bytearray()
+    for name, content in parts.items():
+        body += (
+            f"--{boundary}\r\n"
+            f"Content-Type: {mime_type}\r\n"
+            f'Content-Disposition: inline; name="{name}"; filename="{filename_prefix}_{name}{extension}"\r\n'
+            f"Content-Length: {len(content)}\r\n\r\n"
+        ).encode("utf-8")
+        body += content
+        body += b"\r\n"
+    body += f"--{boundary}--\r\n".encode("utf-8")
+    return Response(content=bytes(body), media_type=f"multipart/mixed; boundary={boundary}", headers=headers)
+
+@app.get("/search")
+async def search_apartment(
+    request: Request,
+    apartment: str = Query(..., description="ID căn hộ (VD: CH01, CH02)", examples=["CH01"]),
+    zoom_size: int = Query(100, description="Kích thước vùng zoom (px)", ge=10, le=3000),
+    format: str = Query("json", description="Định dạng trả về: json, images hoặc multipart"),
+    max_dim: Optional[int] = Query(None, description="Kích thước tối đa (px) của ảnh trả về", ge=64, le=3000),
+    image_format: str = Query("jpeg", description="Định dạng ảnh: jpeg, webp hoặc png"),
+    quality: Optional[int] = Query(None, description="Chất lượng nén 1-100 (jpeg/webp)", ge=1, le=100),
+    progressive: bool = Query(False, description="JPEG progressive"),
+    layer: Optional[str] = Query(None, description="Layer trả về khi format=images: blueprint hoặc map"),
+    upload: Optional[str] = Query(None, description="Với format=json: sync (chờ upload) hoặc background (trả về ngay)")
+):
+    """
+    🔍 Tìm kiếm căn hộ và trả về ảnh đã zoom với marker đỏ
+    
+    - **apartment**: ID căn hộ (CH01, CH02, ...)
+    - **zoom_size**: Kích thước vùng zoom (10-300px)
+    - **format**: 'json' trả về Cloudinary URLs, 'images' trả về ảnh thô của một layer,
+      'multipart' trả về ảnh thô của tất cả layer trong một response multipart/mixed
+    - **max_dim**: Giới hạn kích thước ảnh; zoom rộng sẽ render từ ảnh độ phân giải thấp hơn
+    - **image_format**, **quality**, **progressive**: Encoding của ảnh (mặc định JPEG của OpenCV)
+    - **layer**: Với format=images, mặc định blueprint (hoặc map nếu căn chỉ có trên map)
+    - **upload**: 'background' trả về ngay URL local (/images/{key}) kèm upload_job; poll
+      GET /uploads/{job_id} để lấy Cloudinary URL. Mặc định theo UPLOAD_MODE
+    
+    Response có ETag theo version dữ liệu + tham số; gửi lại If-None-Match sẽ nhận
+    304 mà không render lại.
+    """
+    if format not in ("json", "images", "multipart"):
+        raise HTTPException(status_code=400, detail="format phải là json, images hoặc multipart")
+    if layer is not None and layer not in ("blueprint", "map"):
+        raise HTTPException(status_code=400, detail="layer phải là blueprint hoặc map")
+    upload = (upload or UPLOAD_MODE).lower()
+    if upload not in ("sync", "background"):
+        raise HTTPException(status_code=400, detail="upload phải là sync hoặc background")
+    try:
+        encoding = make_encoding(image_format, quality, progressive)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    mime_type = IMAGE_FORMATS[encoding[0]][1]
+    
+    try:
+        searcher = get_searcher()
+        apartment_id = apartment.upper().strip()
+        # Chỉ trả 304 khi response sẽ là 200: kiểm tra căn (và layer với format=images) tồn tại trước
+        blueprint_coords, map_coords = searcher.get_apartment_coords(apartment_id)
+        if not blueprint_coords and not map_coords:
+            raise HTTPException(status_code=404, detail=f"Không tìm thấy căn hộ {apartment_id}")
+        image_type = layer or ("blueprint" if blueprint_coords else "map")
+        if format == "images" and not (blueprint_coords if image_type == "blueprint" else map_coords):
+            raise HTTPException(status_code=404, detail=f"Căn {apartment_id} không có trên layer {image_type}")
+        etag = make_etag(
+            searcher.data_version, "search", apartment_id, zoom_size, format, max_dim, encoding, layer
+        )
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        
+        result = await run_search(searcher, apartment, zoom_size, max_dim, encoding)
+        found_in_header = {"X-Found-In": ",".join(result["found_in"]), **cache_headers(etag)}
+        
+        if format == "images":
+            # Trả về ảnh thô (binary) của một layer
+            return Response(
+                content=result["encoded"][image_type],
+                media_type=mime_type,
+                headers={**found_in_header, "X-Image-Layer": image_type}
+            )
+        
+        if format == "multipart":
+            return multipart_response(
+                result["encoded"], mime_type, f"{result['apartment_id']}_zoom{zoom_size}", found_in_header
+            )
+        
+        # Chuyển images sang Cloudinary URLs cho JSON response
+        upload_job = None
+        if upload == "background" and IMAGE_STORAGE != "local":
+            images_urls, upload_job = await enqueue_upload_images(
+                result["encoded"], apartment, zoom_size, result["pyramid_levels"], encoding
+            )
+        else:
+            images_urls = await upload_images(
+                result["encoded"], apartment, zoom_size, result["pyramid_levels"], encoding
+            )
+        
+        content = {
+            "success": True,
+            "data": {
+                "apartment_id": result["apartment_id"],
+                "found_in": result["found_in"],
+                "coordinates": {
+                    k: v for k, v in result.items() 
+                    if k.endswith("_coords")
+                },
+                "zoom_size": zoom_size,
+                "max_dim": max_dim,
+                "image_format": encoding[0],
+                "images_urls": images_urls
+            }
+        }
+        if upload_job is not None:
+            content["data"]["upload_job"] = upload_job_view(upload_job)
+        if upload_job is not None or any(url.startswith("data:") for url in images_urls.values()):
+            # Upload đang chạy nền (URL local tạm) hoặc lỗi (base64 fallback): không cho cache
+            # để lần sau nhận secure_url
+            return JSONResponse(content=content, headers={"Cache-Control": "no-store"})
+        return cacheable_json(content, etag)
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
+
+@app.get("/images/{key}")
+async def get_stored_image(key: str, request: Request):
+    """
+    🖼️ Ảnh đã render lưu trong local storage (IMAGE_STORAGE=local hoặc upload nền)
 
-def upload_to_cloudinary(image: np.ndarray, apartment_id: str, image_type: str, zoom_size: int) -> str:
+    Key là hash nội dung nên response được cache vĩnh viễn (immutable). File được
+    gửi qua FileResponse (sendfile khi server hỗ trợ), không đọc vào bộ nhớ.
     """
-    Upload image lên Cloudinary và trả về URL
+    path = local_image_store.path(key)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy ảnh")
     
-    Args:
-        image: OpenCV image array
-        apartment_id: ID căn hộ
-        image_type: Loại ảnh (blueprint/map)
-        zoom_size: Kích thước zoom để đảm bảo unique public_id
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Không tìm thấy ảnh")
+    headers = {"ETag": f'"{key.split(".")[0]}"', "Cache-Control": "public, max-age=31536000, immutable"}
+    if etag_matches(request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
     
-    Returns:
-        str: URL của ảnh trên Cloudinary
+    media_type = next(mime for ext, mime in IMAGE_FORMATS.values() if key.endswith(ext))
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@app.get("/uploads/{job_id}")
+async def get_upload_job(job_id: str):
     """
-    try:
-        # Encode image to bytes
-        _, buffer = cv2.imencode('.jpg', image)
-        image_bytes = buffer.tobytes()
-        
-        # Prepare form data equivalent to curl command
-        files = {
-            'file': ('apartment.jpg', image_bytes, 'image/jpeg')
-        }
-        
-        data = {
-            'upload_preset': 'portal',
-            'folder': 'other',
-            'public_id': f'apartment_{apartment_id}_{image_type}_zoom{zoom_size}'
-        }
-        
-        # Upload to Cloudinary via HTTP POST
-        response = requests.post(
-            'https://api.cloudinary.com/v1_1/farmcode/image/upload',
-            files=files,
-            data=data,
-            timeout=30
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            return result.get('secure_url', result.get('url'))
-        else:
-            print(f"❌ Cloudinary upload failed: {response.status_code} - {response.text}")
-            # Fallback to base64 if upload fails
-            return f"data:image/jpeg;base64,{image_to_base64(image)}"
-        
-    except Exception as e:
-        print(f"❌ Lỗi upload Cloudinary: {e}")
-        # Fallback to base64 if Cloudinary fails
-        return f"data:image/jpeg;base64,{image_to_base64(image)}"
+    ⏳ Trạng thái job upload nền của /search?upload=background
 
-@app.get("/search")
-async def search_apartment(
-    apartment: str = Query(..., description="ID căn hộ (VD: CH01, CH02)", examples=["CH01"]),
-    zoom_size: int = Query(100, description="Kích thước vùng zoom (px)", ge=10, le=3000),
-    format: str = Query("json", description="Định dạng trả về: json hoặc images")
-):
+    status: queued / running / done / failed. images_urls chứa Cloudinary URL
+    của layer đã upload xong, layer còn lại giữ URL local (/images/{key}).
     """
-    🔍 Tìm kiếm căn hộ và trả về ảnh đã zoom với marker đỏ
+    job = upload_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy job upload (sai ID hoặc đã hết hạn)")
+    headers = {"Cache-Control": "no-store"}
+    if job["finished_at"] is None:
+        headers["Retry-After"] = "1"
+    return JSONResponse(content={"success": True, "data": upload_job_view(job)}, headers=headers)
+
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 200))
+
+@app.post("/search/batch")
+async def search_apartments_batch(request: Dict):
+    """
+    🔍 Tìm kiếm nhiều căn hộ trong một request
     
-    - **apartment**: ID căn hộ (CH01, CH02, ...)
-    - **zoom_size**: Kích thước vùng zoom (10-300px)
-    - **format**: 'json' trả về Cloudinary URLs, 'images' trả về raw images
+    Body:
+    {
+        "apartments": ["CH01", "CH02", "CH03"],
+        "zoom_sizes": [100, 400],
+        "max_dim": 1024,
+        "image_format": "webp",
+        "quality": 80
+    }
+    
+    Mỗi cặp (căn, zoom) chỉ được render + upload một lần dù xuất hiện nhiều lần;
+    các cặp được render song song qua render_executor và upload đồng thời.
     """
+    apartments = request.get("apartments")
+    zoom_sizes = request.get("zoom_sizes", [request.get("zoom_size", 100)])
+    max_dim = request.get("max_dim")
+    
+    if not isinstance(apartments, list) or not apartments:
+        raise HTTPException(status_code=400, detail="apartments phải là danh sách ID căn hộ không rỗng")
+    if not isinstance(zoom_sizes, list) or not zoom_sizes:
+        raise HTTPException(status_code=400, detail="zoom_sizes phải là danh sách không rỗng")
+    if any(not isinstance(z, int) or not 10 <= z <= 3000 for z in zoom_sizes):
+        raise HTTPException(status_code=400, detail="zoom_sizes phải là số nguyên trong khoảng 10-3000")
+    if max_dim is not None and (not isinstance(max_dim, int) or not 64 <= max_dim <= 3000):
+        raise HTTPException(status_code=400, detail="max_dim phải là số nguyên trong khoảng 64-3000")
+    quality = request.get("quality")
+    if quality is not None and not isinstance(quality, int):
+        raise HTTPException(status_code=400, detail="quality phải là số nguyên trong khoảng 1-100")
+    try:
+        encoding = make_encoding(
+            str(request.get("image_format", "jpeg")), quality, bool(request.get("progressive", False))
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    # Chuẩn hóa + loại trùng, giữ thứ tự
+    apartment_ids = list(dict.fromkeys(str(a).upper().strip() for a in apartments))
+    zoom_sizes = list(dict.fromkeys(zoom_sizes))
+    if len(apartment_ids) * len(zoom_sizes) > BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Tối đa {BATCH_MAX_ITEMS} cặp (căn, zoom) mỗi request"
+        )
+    
     try:
         searcher = get_searcher()
-        result = searcher.search_apartment(apartment, zoom_size)
         
-        if format == "images":
-            # Trả về ảnh thô (binary)
-            if "blueprint" in result["images"]:
-                blueprint_img = result["images"]["blueprint"]
-                _, buffer = cv2.imencode('.jpg', blueprint_img)
-                return Response(content=buffer.tobytes(), media_type="image/jpeg")
+        # Tra tọa độ hàng loạt để loại căn không tồn tại trước khi render
+        coords = searcher.coord_catalog.get_many(apartment_ids)
+        missing = ApartmentCoordCatalog.MISSING
+        found_mask = (coords["blueprint"][:, 0] != missing) | (coords["map"][:, 0] != missing)
+        found_ids = [a for a, found in zip(apartment_ids, found_mask) if found]
+        not_found = [a for a, found in zip(apartment_ids, found_mask) if not found]
         
-        # Chuyển images sang Cloudinary URLs cho JSON response
-        images_urls = {}
-        for img_type, img_data in result["images"].items():
-            cloudinary_url = upload_to_cloudinary(img_data, apartment, img_type, zoom_size)
-            images_urls[img_type] = cloudinary_url
+        # Giới hạn số job render của batch này để không làm đầy hàng đợi chung
+        render_slots = asyncio.Semaphore(render_executor.max_workers)
         
-        return {
-            "success": True,
-            "data": {
-                "apartment_id": result["apartment_id"],
+        async def process(apartment_id: str, zoom_size: int) -> Dict:
+            async with render_slots:
+                result = await run_search(searcher, apartment_id, zoom_size, max_dim, encoding)
+            images_urls = await upload_images(
+                result["encoded"], apartment_id, zoom_size, result["pyramid_levels"], encoding
+            )
+            return {
+                "apartment_id": apartment_id,
                 "found_in": result["found_in"],
                 "coordinates": {
-                    k: v for k, v in result.items() 
+                    k: v for k, v in result.items()
                     if k.endswith("_coords")
                 },
                 "zoom_size": zoom_size,
                 "images_urls": images_urls
             }
+        
+        results = await asyncio.gather(*(
+            process(apartment_id, zoom_size)
+            for apartment_id in found_ids
+            for zoom_size in zoom_sizes
+        ))
+        
+        return {
+            "success": True,
+            "data": {
+                "total": len(results),
+                "max_dim": max_dim,
+                "image_format": encoding[0],
+                "results": results,
+                "not_found": not_found
+            }
         }
         
     except HTTPException:
@@ -336,18 +2463,432 @@ async def search_apartment(
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
 # OpenAI Configuration
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY environment variable is required")
-client = openai.OpenAI(api_key=api_key)
+# Client được khởi tạo lazy (hoặc trong lifespan khi PRELOAD_DATA=true) để import nhanh
+async_client = None
+_openai_client_lock = threading.Lock()
+
+class LLMConfigError(ValueError):
+    """Thiếu cấu hình OpenAI (OPENAI_API_KEY)"""
+
+
+def get_async_openai_client() -> openai.AsyncOpenAI:
+    """Lazy initialization của AsyncOpenAI client (dùng chung connection pool)"""
+    global async_client
+    if async_client is None:
+        with _openai_client_lock:
+            if async_client is None:
+                api_key = os.getenv("OPENAI_API_KEY")
+                if not api_key:
+                    raise LLMConfigError("OPENAI_API_KEY environment variable is required")
+                # Không retry trong SDK: LLM_TIMEOUT là deadline của cả lời gọi, lỗi được LLMGate ghi nhận ngay
+                async_client = openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+    return async_client
+
+def preload_openai_client():
+    """Load module openai + tạo client trước (gọi từ lifespan), bỏ qua nếu thiếu API key"""
+    try:
+        get_async_openai_client()
+    except ValueError as e:
+        print(f"⚠️ {e}")
+
+# Admission control + circuit breaker cho OpenAI
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", 2))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", 20))
+LLM_SLOW_CALL_SECONDS = float(os.getenv("LLM_SLOW_CALL_SECONDS", 8))
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", 20))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", 5))
+LLM_BREAKER_FAILURE_RATIO = float(os.getenv("LLM_BREAKER_FAILURE_RATIO", 0.5))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", 30))
+
+class LLMUnavailable(Exception):
+    """Không gọi OpenAI: circuit breaker đang mở hoặc chờ slot quá lâu"""
+
+
+def is_llm_config_error(error: Exception) -> bool:
+    """Lỗi cấu hình / request (thiếu / sai API key, model, tham số): không phải dấu hiệu OpenAI quá tải"""
+    return isinstance(error, (
+        LLMConfigError, openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError, openai.BadRequestError
+    ))
+
+
+class LLMGate:
+    """
+    Admission control + circuit breaker cho lời gọi OpenAI
+
+    Tối đa `concurrency` lời gọi chạy song song; lời gọi chờ slot quá
+    `queue_timeout` giây bị từ chối ngay (LLMUnavailable) thay vì xếp hàng tới
+    khi client timeout. Lời gọi được tính là lỗi nếu raise exception hoặc
+    phản hồi chậm hơn `slow_call` giây (với streaming: tới token đầu tiên).
+    Khi tỉ lệ lỗi trong `window` lời gọi gần nhất đạt `failure_ratio`, breaker
+    mở và từ chối mọi lời gọi trong `cooldown` giây, sau đó cho đúng một lời
+    gọi thử (half-open) để quyết định đóng lại hay mở tiếp.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, concurrency: int, queue_timeout: float, slow_call: float, window: int,
+                 min_calls: int, failure_ratio: float, cooldown: float):
+        self.concurrency = concurrency
+        self.queue_timeout = queue_timeout
+        self.slow_call = slow_call
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._semaphore = None
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _reject(self, reason: str, message: str) -> LLMUnavailable:
+        metrics.inc("apartment_llm_rejected_total", reason=reason)
+        return LLMUnavailable(message)
+
+    def _admit(self) -> bool:
+        """Kiểm tra breaker; trả về True nếu lời gọi này là lời gọi thử (half-open)"""
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.cooldown:
+                raise self._reject("circuit_open", "OpenAI đang lỗi hoặc phản hồi chậm, tạm ngưng gọi")
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                raise self._reject("circuit_open", "OpenAI đang lỗi hoặc phản hồi chậm, tạm ngưng gọi")
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def _record(self, ok: bool, probe: bool):
+        if probe:
+            if ok:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+        if self.state != self.CLOSED:
+            # Lời gọi bắt đầu trước khi breaker mở, không ảnh hưởng trạng thái hiện tại
+            return
+        self._outcomes.append(ok)
+        calls = len(self._outcomes)
+        if calls >= self.min_calls and self._outcomes.count(False) / calls >= self.failure_ratio:
+            self._open()
+
+    def _open(self):
+        print(f"⚠️ Circuit breaker OpenAI mở trong {self.cooldown:g}s")
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        metrics.inc("apartment_llm_circuit_opened_total")
+
+    @asynccontextmanager
+    async def slot(self):
+        """
+        `async with llm_gate.slot() as call:` bao quanh một lời gọi OpenAI
+
+        Lời gọi streaming đặt call["latency"] = thời gian tới token đầu tiên;
+        mặc định dùng thời gian của cả khối lệnh.
+        """
+        probe = self._admit()
+        try:
+            semaphore = self._get_semaphore()
+            started_at = time.perf_counter()
+            try:
+                await asyncio.wait_for(semaphore.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                raise self._reject(
+                    "queue_timeout", f"Quá nhiều câu hỏi đang chờ AI (hơn {self.queue_timeout:g}s)"
+                ) from None
+            record_stage("llm_queue", time.perf_counter() - started_at)
+            
+            call = {"latency": None}
+            started_at = time.perf_counter()
+            try:
+                yield call
+            except Exception as e:
+                if not is_llm_config_error(e):
+                    self._record(False, probe)
+                raise
+            finally:
+                semaphore.release()
+            latency = call["latency"] if call["latency"] is not None else time.perf_counter() - started_at
+            self._record(latency <= self.slow_call, probe)
+        finally:
+            if probe:
+                self._probe_in_flight = False
+
+    def stats(self) -> Dict:
+        return {
+            "state": self.state,
+            "concurrency": self.concurrency,
+            "window_calls": len(self._outcomes),
+            "window_failures": self._outcomes.count(False)
+        }
+
+llm_gate = LLMGate(
+    LLM_CONCURRENCY, LLM_QUEUE_TIMEOUT, LLM_SLOW_CALL_SECONDS, LLM_BREAKER_WINDOW,
+    LLM_BREAKER_MIN_CALLS, LLM_BREAKER_FAILURE_RATIO, LLM_BREAKER_COOLDOWN
+)
+
+class AnswerCache:
+    """
+    Cache câu trả lời AI theo (căn được chọn + bộ lọc chuẩn hóa của query)
+
+    Tầng nhớ là LRU có TTL; tầng persistent là SQLite dùng chung giữa các
+    worker. Mỗi câu trả lời gắn với version (sha256) của sheet.csv lúc tạo:
+    get() chỉ trả về câu trả lời của version hiện tại, và sau khi reload
+    sheet.csv thì purge_stale() xóa các câu trả lời của version cũ.
+    """
+
+    def __init__(self, path: str, max_entries: int = 1024, ttl_seconds: float = 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = open_sqlite(
+                self.path,
+                "CREATE TABLE IF NOT EXISTS answers ("
+                "key TEXT PRIMARY KEY, sheet_version TEXT NOT NULL, "
+                "answer TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+        return self._conn
+
+    @staticmethod
+    def make_key(context: Dict) -> str:
+        """Key từ căn được chọn (Căn STT, Mã căn + nội dung bản ghi) + bộ lọc đã chuẩn hóa"""
+        selected = context["selected_apartment"]
+        payload = {
+            "apartment": [int(selected["Căn STT"]), str(selected["Mã căn"])],
+            "record": sorted((str(k), str(v)) for k, v in context["apartment_info"].items()),
+            "filters": sorted((str(k), str(v)) for k, v in context["filters"].items())
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def purge_stale(self, sheet_version: str) -> int:
+        """Xóa các câu trả lời của version sheet.csv khác sheet_version hoặc đã hết TTL (gọi sau khi reload)"""
+        now = time.time()
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[1] <= now or entry[2] != sheet_version]:
+                del self._entries[key]
+            try:
+                conn = self._connection()
+                deleted = conn.execute(
+                    "DELETE FROM answers WHERE sheet_version != ? OR created_at + ? <= ?",
+                    (sheet_version, self.ttl_seconds, now)
+                ).rowcount
+                conn.commit()
+                return deleted
+            except (sqlite3.Error, OSError) as e:
+                print(f"⚠️ Answer cache lỗi dọn entry hết hạn: {e}")
+                return 0
+
+    def get(self, key: str, sheet_version: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > now and entry[2] == sheet_version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+            
+            try:
+                row = self._connection().execute(
+                    "SELECT answer, created_at FROM answers WHERE key = ? AND sheet_version = ?",
+                    (key, sheet_version)
+                ).fetchone()
+            except (sqlite3.Error, OSError) as e:
+                print(f"⚠️ Answer cache lỗi đọc: {e}")
+                row = None
+            if row is not None and row[1] + self.ttl_seconds > now:
+                self._remember(key, row[0], row[1] + self.ttl_seconds, sheet_version)
+                self.hits += 1
+                return row[0]
+            self.misses += 1
+            return None
+
+    def _remember(self, key: str, answer: str, expires_at: float, sheet_version: str):
+        self._entries[key] = (answer, expires_at, sheet_version)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, key: str, sheet_version: str, answer: str):
+        now = time.time()
+        with self._lock:
+            self._remember(key, answer, now + self.ttl_seconds, sheet_version)
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT OR REPLACE INTO answers (key, sheet_version, answer, created_at) VALUES (?, ?, ?, ?)",
+                    (key, sheet_version, answer, now)
+                )
+                conn.commit()
+            except (sqlite3.Error, OSError) as e:
+                print(f"⚠️ Answer cache lỗi ghi: {e}")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0
+            }
+
+answer_cache = AnswerCache(
+    os.getenv("LLM_CACHE_PATH", os.path.join(CACHE_DIR, "answer_cache.sqlite3")),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", 1024)),
+    ttl_seconds=float(os.getenv("LLM_CACHE_TTL", 24 * 3600))
+)
+
+# Ảnh trong /chat: vùng zoom rộng, render từ tầng pyramid để ảnh không vượt quá CHAT_MAX_IMAGE_DIM
+CHAT_ZOOM_SIZE = 2000
+CHAT_MAX_IMAGE_DIM = int(os.getenv("CHAT_MAX_IMAGE_DIM", 1024)) or None
+
+NOT_FOUND_MESSAGE = "Không tìm thấy căn hộ phù hợp với yêu cầu của bạn. Vui lòng kiểm tra lại thông tin như số căn, tầng, hoặc phân khu."
+
+# Fast path: câu hỏi khớp đúng một căn và chỉ hỏi thông tin có sẵn -> trả lời bằng template, không gọi OpenAI
+CHAT_FAST_PATH = os.getenv("CHAT_FAST_PATH", "true").lower() == "true"
+
+VIETNAMESE_CHARS = re.compile(r"[àáạảãâầấậẩẫăằắặẳẵèéẹẻẽêềếệểễìíịỉĩòóọỏõôồốộổỗơờớợởỡùúụủũưừứựửữỳýỵỷỹđ]")
+
+# Trường thông tin -> pattern nhận biết câu hỏi về trường đó (vi + en)
+FACT_PATTERNS = {
+    "loại_hình": re.compile(r"loại hình|loại căn|mấy phòng|bao nhiêu phòng|\d*\s*pn\b|\btype\b|bedroom|layout"),
+    "diện_tích": re.compile(r"diện tích|\bdt\b|\bm2\b|m²|rộng|\barea\b|\bsize\b|square"),
+    "giá": re.compile(r"giá|bao nhiêu tiền|\bprice\b|\bcost\b|how much"),
+    "căn_góc": re.compile(r"góc|\bcorner\b")
+}
+# Hỏi thông tin chung / đầy đủ (trả lời tất cả các trường)
+GENERAL_FACT_PATTERN = re.compile(r"thông tin|chi tiết|đầy đủ|\binfo\b|information|details?\b")
+# Cụm từ là điều kiện lọc (phân khu, tầng, căn góc, số căn như parse_query, loại hình kèm số phòng),
+# bỏ đi trước khi tìm trường được hỏi để "căn góc" / "2PN" không bị hiểu là câu hỏi
+FILTER_TERM_PATTERN = re.compile(
+    r"(?:phân khu\s*)?origami|(?:tầng|floor)\s*\d+|căn góc|can goc|\bcorner\b|"
+    r"căn\s*(?:hộ\s*)?(?:số\s*)?\d+|số\s*\d+|(?:unit|apartment|apt)\s*(?:no\.?|number|#)?\s*\d+|"
+    r"(?:loại\s*(?:hình\s*)?)?\d\s*pn(?:\s*\+\s*\d)?"
+)
+# Câu hỏi cần tư vấn / so sánh / đánh giá -> vẫn gọi OpenAI
+OPEN_ENDED_PATTERN = re.compile(
+    r"tư vấn|\bnên\b|so sánh|ưu điểm|nhược điểm|tại sao|vì sao|phù hợp|gợi ý|đánh giá|đáng|"
+    r"\bcó\s+(?!phải\b)[^?,.]*\bkhông\b|"
+    r"recommend|should|compare|\bwhy\b|\bpros\b|\bcons\b|worth|suitable|advice|advise|\bis it\b|\bgood\b"
+)
+
+ANSWER_TEMPLATES = {
+    "vi": {
+        "intro": "Căn {mã_căn} (căn số {căn_số}) thuộc phân khu {phân_khu}, tầng {tầng}",
+        "loại_hình": "loại hình {loại_hình}",
+        "diện_tích": "diện tích tim tường {diện_tích_tim_tường} m² (thông thủy {diện_tích_thông_thủy} m²)",
+        "giá": "tổng giá trước VAT + KPBT {giá}",
+        "căn_góc": ("không phải căn góc", "là căn góc"),
+        "more": "Có {tổng_căn_tìm_được} căn phù hợp với yêu cầu của bạn, đây là căn đầu tiên.",
+        "busy": "Trợ lý AI đang bận, vui lòng hỏi lại sau để được tư vấn chi tiết hơn.",
+        "config": "Trợ lý AI chưa được cấu hình đúng, vui lòng liên hệ quản trị viên."
+    },
+    "en": {
+        "intro": "Apartment {mã_căn} (unit {căn_số}) is in the {phân_khu} subdivision, floor {tầng}",
+        "loại_hình": "type {loại_hình}",
+        "diện_tích": "built-up area {diện_tích_tim_tường} m² (net area {diện_tích_thông_thủy} m²)",
+        "giá": "total price before VAT and maintenance fee {giá}",
+        "căn_góc": ("not a corner unit", "a corner unit"),
+        "more": "{tổng_căn_tìm_được} apartments match your request; this is the first one.",
+        "busy": "The AI assistant is busy, please ask again later for more detailed advice.",
+        "config": "The AI assistant is not configured correctly, please contact the administrator."
+    }
+}
+
+def detect_locale(query: str) -> str:
+    """'vi' nếu câu hỏi có dấu tiếng Việt hoặc không rõ ngôn ngữ, 'en' nếu là tiếng Anh"""
+    query_lower = query.lower()
+    if VIETNAMESE_CHARS.search(query_lower):
+        return "vi"
+    if re.search(r"\b(what|which|how|is|the|price|floor|apartment|unit|area|corner)\b", query_lower):
+        return "en"
+    return "vi"
+
+def sse_event(event: str, data: Dict) -> str:
+    """Định dạng một event server-sent events"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+class TokenStream:
+    """
+    Câu trả lời streaming của OpenAI dùng chung giữa các request /chat/stream cùng ý định
+
+    Producer (một task) publish từng đoạn text; mỗi subscriber đọc lại từ đầu
+    rồi chờ đoạn tiếp theo, nên request đến sau vẫn nhận đủ token mà không mở
+    thêm lời gọi OpenAI.
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.answer = None
+        self.error = None
+        self.done = False
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def publish(self, part: str):
+        self.parts.append(part)
+        self._notify()
+
+    def finish(self, answer: Optional[str] = None, error: Optional[Exception] = None):
+        self.answer = answer
+        self.error = error
+        self.done = True
+        self._notify()
+
+    async def subscribe(self):
+        """Các đoạn text theo thứ tự, kết thúc khi stream xong (kể cả khi lỗi)"""
+        i = 0
+        while True:
+            while i < len(self.parts):
+                yield self.parts[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+    async def result(self) -> str:
+        """Toàn bộ câu trả lời (raise exception của producer nếu lỗi)"""
+        while not self.done:
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+        return self.answer
+
+# cache_key câu trả lời AI -> TokenStream đang chạy
+llm_streams: Dict[str, TokenStream] = {}
 
 class ChatAgent:
     def __init__(self, searcher: ApartmentSearcher):
         self.searcher = searcher
         
-    def filter_apartments_by_query(self, query: str) -> List[Dict]:
+    def parse_query(self, query: str) -> Dict:
         """
-        Phân tích query và lọc căn hộ phù hợp từ sheet.csv
+        Phân tích query thành bộ lọc chuẩn hóa
+
+        Returns:
+            Dict cột -> giá trị; số căn (nếu có) nằm ở key "Căn STT"
         """
         query_lower = query.lower()
         
@@ -359,12 +2900,12 @@ class ChatAgent:
             filters["PHÂN KHU"] = "Origami"
         
         # Lọc theo tầng
-        floor_match = re.search(r"tầng\s*(\d+)", query_lower)
+        floor_match = re.search(r"(?:tầng|floor)\s*(\d+)", query_lower)
         if floor_match:
             filters["Tầng"] = int(floor_match.group(1))
         
         # Lọc theo căn góc
-        if "căn góc" in query_lower or "can goc" in query_lower:
+        if "căn góc" in query_lower or "can goc" in query_lower or "corner" in query_lower:
             filters["căn góc"] = True
         
         # Lọc theo số căn cụ thể
@@ -372,7 +2913,8 @@ class ChatAgent:
         apartment_number_patterns = [
             r"căn\s*(?:số|hộ)?\s*(\d+)",
             r"số\s*(\d+)",
-            r"căn\s*(\d+)"
+            r"căn\s*(\d+)",
+            r"(?:unit|apartment|apt)\s*(?:no\.?|number|#)?\s*(\d+)"
         ]
         
         apartment_number = None
@@ -382,19 +2924,21 @@ class ChatAgent:
                 apartment_number = int(match.group(1))
                 break
         
-        # Áp dụng bộ lọc
-        filtered_data = self.searcher.sheet_data.copy()
-        
-        for column, value in filters.items():
-            if column in filtered_data.columns:
-                filtered_data = filtered_data[filtered_data[column] == value]
-        
-        # Lọc theo số căn nếu có
         if apartment_number is not None:
-            filtered_data = filtered_data[filtered_data["Căn STT"] == apartment_number]
+            filters["Căn STT"] = apartment_number
+        
+        return filters
+    
+    def filter_apartments_by_query(self, query: str, filters: Optional[Dict] = None) -> List[Dict]:
+        """
+        Phân tích query và lọc căn hộ phù hợp từ sheet.csv
+        """
+        if filters is None:
+            filters = self.parse_query(query)
         
-        # Chuyển đổi sang dạng list of dict để dễ xử lý
-        return filtered_data.to_dict('records')
+        # Áp dụng bộ lọc trên index dựng sẵn, không copy sheet
+        with stage("filter"):
+            return self.searcher.filter_index.query(filters=filters)
     
     def apartment_id_to_ch_format(self, apartment_stt: int) -> str:
         """
@@ -403,10 +2947,16 @@ class ChatAgent:
         """
         return f"CH{apartment_stt:02d}"
     
-    def format_price(self, price: float) -> str:
+    def format_price(self, price: float, locale: str = "vi") -> str:
         """
         Format giá tiền thành dạng dễ đọc
         """
+        if locale == "en":
+            if price >= 1000000000:
+                return f"{price/1000000000:.1f} billion VND"
+            elif price >= 1000000:
+                return f"{price/1000000:.0f} million VND"
+            return f"{price:,.0f} VND"
         if price >= 1000000000:  # Tỷ
             return f"{price/1000000000:.1f} tỷ VNĐ"
         elif price >= 1000000:  # Triệu
@@ -414,51 +2964,40 @@ class ChatAgent:
         else:
             return f"{price:,.0f} VNĐ"
     
-    async def process_query(self, user_query: str) -> Dict:
+    def build_context(self, user_query: str) -> Optional[Dict]:
         """
-        Xử lý query từ user và trả về kết quả kèm ảnh
+        Lọc căn hộ, chọn căn phù hợp nhất và dựng prompt cho OpenAI
+
+        Returns:
+            None nếu không có căn nào phù hợp
         """
-        try:
-            # 1. Lọc căn hộ phù hợp
-            filtered_apartments = self.filter_apartments_by_query(user_query)
-            
-            if not filtered_apartments:
-                return {
-                    "success": False,
-                    "message": "Không tìm thấy căn hộ phù hợp với yêu cầu của bạn. Vui lòng kiểm tra lại thông tin như số căn, tầng, hoặc phân khu.",
-                    "apartments": [],
-                    "images": []
-                }
-            
-            # 2. Chọn căn hộ phù hợp nhất (căn đầu tiên trong kết quả đã lọc)
-            selected_apartment = filtered_apartments[0]
-            apartment_ch_id = self.apartment_id_to_ch_format(selected_apartment["Căn STT"])
-            
-            # 3. Gọi API search để lấy ảnh
-            search_result = self.searcher.search_apartment(apartment_ch_id, zoom_size=2000)
-            
-            # 4. Upload ảnh lên Cloudinary
-            images_urls = {}
-            for img_type, img_data in search_result["images"].items():
-                cloudinary_url = upload_to_cloudinary(img_data, apartment_ch_id, img_type, 2000)
-                images_urls[img_type] = cloudinary_url
-            
-            # 5. Tạo prompt cho OpenAI
-            apartment_info = {
-                "mã_căn": selected_apartment["Mã căn"],
-                "ch_id": apartment_ch_id,
-                "phân_khu": selected_apartment["PHÂN KHU"],
-                "tầng": selected_apartment["Tầng"],
-                "căn_số": selected_apartment["Căn STT"],
-                "loại_hình": selected_apartment["Loại hình"],
-                "diện_tích_tim_tường": selected_apartment["DT tim tường"],
-                "diện_tích_thông_thủy": selected_apartment["DT thông thủy"],
-                "giá": selected_apartment["Tổng giá trước VAT + KPBT"],
-                "là_căn_góc": selected_apartment["căn góc"],
-                "tổng_căn_tìm_được": len(filtered_apartments)
-            }
-            
-            prompt = f"""
+        # 1. Lọc căn hộ phù hợp
+        filters = self.parse_query(user_query)
+        filtered_apartments = self.filter_apartments_by_query(user_query, filters)
+        
+        if not filtered_apartments:
+            return None
+        
+        # 2. Chọn căn hộ phù hợp nhất (căn đầu tiên trong kết quả đã lọc)
+        selected_apartment = filtered_apartments[0]
+        apartment_ch_id = self.apartment_id_to_ch_format(selected_apartment["Căn STT"])
+        
+        # 3. Tạo prompt cho OpenAI
+        apartment_info = {
+            "mã_căn": selected_apartment["Mã căn"],
+            "ch_id": apartment_ch_id,
+            "phân_khu": selected_apartment["PHÂN KHU"],
+            "tầng": selected_apartment["Tầng"],
+            "căn_số": selected_apartment["Căn STT"],
+            "loại_hình": selected_apartment["Loại hình"],
+            "diện_tích_tim_tường": selected_apartment["DT tim tường"],
+            "diện_tích_thông_thủy": selected_apartment["DT thông thủy"],
+            "giá": selected_apartment["Tổng giá trước VAT + KPBT"],
+            "là_căn_góc": selected_apartment["căn góc"],
+            "tổng_căn_tìm_được": len(filtered_apartments)
+        }
+        
+        prompt = f"""
             Bạn là chuyên viên tư vấn bất động sản chuyên nghiệp. Hãy trả lời một cách thân thiện và chi tiết về căn hộ sau:
 
             Thông tin căn hộ:
@@ -478,37 +3017,183 @@ class ChatAgent:
             Hãy trả lời một cách chuyên nghiệp, nêu rõ ưu điểm của căn hộ này và tại sao phù hợp với yêu cầu của khách hàng.
             Trả lời bằng tiếng Việt, khoảng 100-150 từ.
             """
+        
+        return {
+            "filters": filters,
+            "filtered_apartments": filtered_apartments,
+            "selected_apartment": selected_apartment,
+            "apartment_ch_id": apartment_ch_id,
+            "apartment_info": apartment_info,
+            "prompt": prompt,
+            "locale": detect_locale(user_query)
+        }
+    
+    def build_messages(self, prompt: str) -> List[Dict]:
+        """Messages gửi cho OpenAI chat completions"""
+        return [
+            {"role": "system", "content": "Bạn là chuyên viên tư vấn bất động sản chuyên nghiệp và thân thiện."},
+            {"role": "user", "content": prompt}
+        ]
+    
+    def public_apartment_info(self, context: Dict) -> Dict:
+        """Thông tin căn hộ trả về cho client"""
+        apartment_info = context["apartment_info"]
+        return {
+            "mã_căn": apartment_info["mã_căn"],
+            "ch_id": context["apartment_ch_id"],
+            "phân_khu": apartment_info["phân_khu"],
+            "tầng": apartment_info["tầng"],
+            "loại_hình": apartment_info["loại_hình"],
+            "diện_tích_tim_tường": apartment_info["diện_tích_tim_tường"],
+            "diện_tích_thông_thủy": apartment_info["diện_tích_thông_thủy"],
+            "giá_formatted": self.format_price(apartment_info["giá"]),
+            "căn_góc": apartment_info["là_căn_góc"]
+        }
+    
+    def describe_apartment(self, context: Dict, fields: List[str]) -> str:
+        """Câu mô tả căn đã chọn gồm các trường trong fields, theo ANSWER_TEMPLATES[locale]"""
+        templates = ANSWER_TEMPLATES[context["locale"]]
+        values = {**context["apartment_info"], "giá": self.format_price(context["apartment_info"]["giá"], context["locale"])}
+        parts = []
+        for field in fields:
+            if field == "căn_góc":
+                parts.append(templates["căn_góc"][bool(values["là_căn_góc"])])
+            else:
+                parts.append(templates[field].format(**values))
+        return ", ".join([templates["intro"].format(**values)] + parts) + "."
+    
+    def template_answer(self, user_query: str, context: Dict) -> Optional[str]:
+        """
+        Trả lời không cần OpenAI nếu câu hỏi khớp đúng một căn và chỉ hỏi thông tin có sẵn
+
+        VD "Căn hộ số 17, tầng 2, Origami hiện có loại hình và giá bao nhiêu?" chỉ
+        cần loại hình + giá của căn đó. Câu hỏi cần tư vấn / so sánh, hoặc khớp
+        nhiều căn, trả về None để gọi OpenAI.
+        """
+        locale = context["locale"]
+        if len(context["filtered_apartments"]) != 1:
+            metrics.inc("apartment_chat_fast_path_total", result="multiple_matches", locale=locale)
+            return None
+        query_lower = user_query.lower()
+        if OPEN_ENDED_PATTERN.search(query_lower):
+            metrics.inc("apartment_chat_fast_path_total", result="open_ended", locale=locale)
+            return None
+        if GENERAL_FACT_PATTERN.search(query_lower):
+            fields = list(FACT_PATTERNS)
+        else:
+            question = FILTER_TERM_PATTERN.sub(" ", query_lower)
+            fields = [field for field, pattern in FACT_PATTERNS.items() if pattern.search(question)]
+        if not fields:
+            metrics.inc("apartment_chat_fast_path_total", result="not_factual", locale=locale)
+            return None
+        metrics.inc("apartment_chat_fast_path_total", result="hit", locale=locale)
+        return self.describe_apartment(context, fields)
+    
+    def fallback_answer(self, context: Dict) -> str:
+        """Câu trả lời dựng từ apartment_info khi không gọi được OpenAI (quá tải / lỗi)"""
+        templates = ANSWER_TEMPLATES[context["locale"]]
+        answer = self.describe_apartment(context, list(FACT_PATTERNS))
+        if context["apartment_info"]["tổng_căn_tìm_được"] > 1:
+            answer += " " + templates["more"].format(**context["apartment_info"])
+        return answer + " " + templates["busy"]
+    
+    def fast_answer(self, user_query: str, context: Dict) -> Optional[str]:
+        """template_answer nếu bật CHAT_FAST_PATH, thời gian ghi vào stage template"""
+        if not CHAT_FAST_PATH:
+            return None
+        with stage("template"):
+            return self.template_answer(user_query, context)
+    
+    async def fetch_images_urls(self, context: Dict) -> Dict[str, str]:
+        """Render ảnh căn hộ đã chọn và upload lên Cloudinary"""
+        apartment_ch_id = context["apartment_ch_id"]
+        search_result = await run_search(self.searcher, apartment_ch_id, CHAT_ZOOM_SIZE, CHAT_MAX_IMAGE_DIM)
+        return await upload_images(
+            search_result["encoded"], apartment_ch_id, CHAT_ZOOM_SIZE, search_result["pyramid_levels"]
+        )
+    
+    async def fetch_overview_urls(self, context: Dict) -> Dict[str, str]:
+        """
+        Render một ảnh tổng quan mỗi layer đánh dấu tất cả căn phù hợp và upload
+
+        Chỉ dùng khi query khớp nhiều hơn một căn; ngược lại trả về dict rỗng.
+        """
+        filtered_apartments = context["filtered_apartments"]
+        if len(filtered_apartments) < 2:
+            return {}
+        apartment_ids = [self.apartment_id_to_ch_format(a["Căn STT"]) for a in filtered_apartments]
+        overview = await run_searcher_method(
+            self.searcher, "search_apartments_overview", apartment_ids, CHAT_MAX_IMAGE_DIM
+        )
+        return await upload_overview_images(overview)
+    
+    async def fetch_all_images_urls(self, context: Dict) -> Dict[str, Dict[str, str]]:
+        """Ảnh căn đã chọn + ảnh tổng quan các căn phù hợp, render và upload song song"""
+        images_urls, overview_images_urls = await asyncio.gather(
+            self.fetch_images_urls(context), self.fetch_overview_urls(context)
+        )
+        result = {"images_urls": images_urls}
+        if overview_images_urls:
+            result["overview_images_urls"] = overview_images_urls
+        return result
+    
+    async def process_query(self, user_query: str) -> Dict:
+        """
+        Xử lý query từ user và trả về kết quả kèm ảnh
+        """
+        try:
+            context = self.build_context(user_query)
             
-            # 6. Gọi OpenAI
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "Bạn là chuyên viên tư vấn bất động sản chuyên nghiệp và thân thiện."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=300,
-                temperature=0.7
-            )
+            if context is None:
+                return {
+                    "success": False,
+                    "message": NOT_FOUND_MESSAGE,
+                    "apartments": [],
+                    "images": []
+                }
             
-            ai_response = response.choices[0].message.content.strip()
+            # 4. Render ảnh (căn đã chọn + tổng quan nếu nhiều căn) + upload lên Cloudinary
+            images = await self.fetch_all_images_urls(context)
             
-            # 7. Trả về kết quả
+            # 5. Trả lời bằng template nếu được, không thì gọi OpenAI (bỏ qua nếu câu hỏi cùng ý định
+            #    đã được trả lời hoặc đang được trả lời)
+            ai_response = self.fast_answer(user_query, context)
+            answer_source = "template"
+            if ai_response is None:
+                cache_key = answer_cache.make_key(context)
+                # SQLite đọc / ghi ngoài event loop
+                ai_response = await asyncio.to_thread(answer_cache.get, cache_key, self.searcher.sheet_version)
+                answer_source = "cache"
+            if ai_response is None:
+                answer_source = "llm"
+                try:
+                    shared_stream = llm_streams.get(cache_key)
+                    if shared_stream is not None:
+                        metrics.inc("apartment_singleflight_calls_total", group="llm", role="follower")
+                        ai_response = await shared_stream.result()
+                    else:
+                        ai_response = await llm_flight.do(cache_key, self.complete_answer, context, cache_key)
+                except Exception as e:
+                    if is_llm_config_error(e):
+                        # Sai cấu hình: báo lỗi thay vì nói "đang bận" (hỏi lại cũng không khá hơn)
+                        print(f"❌ Lỗi cấu hình OpenAI: {e}")
+                        ai_response = ANSWER_TEMPLATES[context["locale"]]["config"]
+                        answer_source = "config_error"
+                    else:
+                        # OpenAI quá tải / lỗi: trả lời ngay từ dữ liệu căn hộ thay vì báo lỗi
+                        print(f"⚠️ Dùng câu trả lời dự phòng: {e}")
+                        metrics.inc("apartment_llm_fallbacks_total", endpoint="chat")
+                        ai_response = self.fallback_answer(context)
+                        answer_source = "fallback"
+            
+            # 6. Trả về kết quả
             return {
-                "success": True,
+                "success": answer_source != "config_error",
                 "message": ai_response,
-                "apartment_info": {
-                    "mã_căn": apartment_info["mã_căn"],
-                    "ch_id": apartment_ch_id,
-                    "phân_khu": apartment_info["phân_khu"],
-                    "tầng": apartment_info["tầng"],
-                    "loại_hình": apartment_info["loại_hình"],
-                    "diện_tích_tim_tường": apartment_info["diện_tích_tim_tường"],
-                    "diện_tích_thông_thủy": apartment_info["diện_tích_thông_thủy"],
-                    "giá_formatted": self.format_price(apartment_info["giá"]),
-                    "căn_góc": apartment_info["là_căn_góc"]
-                },
-                "images_urls": images_urls,
-                "total_found": len(filtered_apartments)
+                "answer_source": answer_source,
+                "apartment_info": self.public_apartment_info(context),
+                **images,
+                "total_found": len(context["filtered_apartments"])
             }
             
         except Exception as e:
@@ -518,6 +3203,188 @@ class ChatAgent:
                 "apartments": [],
                 "images": []
             }
+    
+    async def complete_answer(self, context: Dict, cache_key: str) -> str:
+        """Gọi OpenAI (không streaming) và lưu câu trả lời vào answer_cache"""
+        sheet_version = self.searcher.sheet_version
+        try:
+            # Tạo client trước khi vào gate: thiếu API key không tính là lỗi của OpenAI
+            client = get_async_openai_client()
+            async with llm_gate.slot():
+                with in_flight("llm"), stage("llm"):
+                    async with asyncio.timeout(LLM_TIMEOUT):
+                        response = await client.chat.completions.create(
+                            model="gpt-4o",
+                            messages=self.build_messages(context["prompt"]),
+                            max_tokens=300,
+                            temperature=0.7
+                        )
+        except LLMUnavailable:
+            raise
+        except Exception:
+            metrics.inc("apartment_llm_errors_total", endpoint="chat")
+            raise
+        
+        ai_response = response.choices[0].message.content.strip()
+        await asyncio.to_thread(answer_cache.put, cache_key, sheet_version, ai_response)
+        return ai_response
+    
+    async def stream_answer(self, context: Dict, cache_key: str, shared: TokenStream):
+        """Gọi OpenAI streaming, publish từng đoạn vào shared và lưu câu trả lời vào answer_cache"""
+        sheet_version = self.searcher.sheet_version
+        try:
+            client = get_async_openai_client()
+            async with llm_gate.slot() as call:
+                started_at = time.perf_counter()
+                with in_flight("llm"):
+                    async with asyncio.timeout(LLM_TIMEOUT):
+                        stream = await client.chat.completions.create(
+                            model="gpt-4o",
+                            messages=self.build_messages(context["prompt"]),
+                            max_tokens=300,
+                            temperature=0.7,
+                            stream=True
+                        )
+                        async for chunk in stream:
+                            if not chunk.choices:
+                                continue
+                            delta = chunk.choices[0].delta.content
+                            if delta:
+                                if not shared.parts:
+                                    call["latency"] = time.perf_counter() - started_at
+                                    record_stage("llm_first_token", call["latency"])
+                                shared.publish(delta)
+                record_stage("llm", time.perf_counter() - started_at)
+            ai_response = "".join(shared.parts).strip()
+            # Publish kết quả trước, ghi cache sau để follower không phải chờ SQLite
+            shared.finish(answer=ai_response)
+            await asyncio.to_thread(answer_cache.put, cache_key, sheet_version, ai_response)
+        except Exception as e:
+            if not isinstance(e, LLMUnavailable):
+                metrics.inc("apartment_llm_errors_total", endpoint="chat_stream")
+            shared.finish(error=e)
+        finally:
+            llm_streams.pop(cache_key, None)
+    
+    def shared_answer_stream(self, context: Dict, cache_key: str) -> TokenStream:
+        """TokenStream đang chạy cho cùng ý định, hoặc bắt đầu một stream mới"""
+        shared = llm_streams.get(cache_key)
+        if shared is not None:
+            metrics.inc("apartment_singleflight_calls_total", group="llm", role="follower")
+            return shared
+        metrics.inc("apartment_singleflight_calls_total", group="llm", role="leader")
+        shared = llm_streams[cache_key] = TokenStream()
+        # Task giữ tham chiếu trong shared: client đầu tiên ngắt kết nối thì các client khác vẫn nhận đủ
+        shared.task = asyncio.create_task(self.stream_answer(context, cache_key, shared))
+        return shared
+    
+    async def stream_query(self, user_query: str):
+        """
+        Giống process_query nhưng trả về từng event SSE
+
+        Thứ tự event: "apartment" ngay sau khi lọc xong, "images" khi upload xong
+        (chạy song song với OpenAI, kèm overview_images_urls nếu nhiều căn), "token" cho mỗi đoạn text từ OpenAI, cuối
+        cùng là "done" với toàn bộ câu trả lời. Lỗi được gửi qua event "error".
+        """
+        try:
+            context = self.build_context(user_query)
+        except Exception as e:
+            yield sse_event("error", {"success": False, "message": f"Có lỗi xảy ra khi xử lý yêu cầu: {str(e)}"})
+            return
+        
+        if context is None:
+            yield sse_event("error", {"success": False, "message": NOT_FOUND_MESSAGE})
+            return
+        
+        yield sse_event("apartment", {
+            "apartment_info": self.public_apartment_info(context),
+            "total_found": len(context["filtered_apartments"])
+        })
+        
+        queue = asyncio.Queue()
+        
+        async def produce_images():
+            try:
+                await queue.put(("images", await self.fetch_all_images_urls(context)))
+            except Exception as e:
+                await queue.put(("images", {"images_urls": {}, "error": str(e)}))
+        
+        async def produce_tokens():
+            # Luôn gửi event "message" để vòng lặp bên dưới kết thúc, kể cả khi
+            # fast path hoặc cache câu trả lời lỗi
+            try:
+                await answer_tokens()
+            except Exception as e:
+                await queue.put(("message", {"error": f"Có lỗi xảy ra khi xử lý yêu cầu: {str(e)}"}))
+        
+        async def answer_tokens():
+            template_answer = self.fast_answer(user_query, context)
+            if template_answer is not None:
+                await queue.put(("token", {"content": template_answer}))
+                await queue.put(("message", {"message": template_answer, "answer_source": "template"}))
+                return
+            
+            cache_key = answer_cache.make_key(context)
+            cached_answer = await asyncio.to_thread(answer_cache.get, cache_key, self.searcher.sheet_version)
+            if cached_answer is not None:
+                await queue.put(("token", {"content": cached_answer}))
+                await queue.put(("message", {"message": cached_answer, "answer_source": "cache"}))
+                return
+            
+            emitted = False
+            try:
+                pending = llm_flight.in_flight(cache_key)
+                if pending is not None:
+                    # /chat cùng ý định đang gọi OpenAI (không streaming): chờ và gửi cả câu trả lời
+                    metrics.inc("apartment_singleflight_calls_total", group="llm", role="follower")
+                    ai_response = await asyncio.shield(pending)
+                    await queue.put(("token", {"content": ai_response}))
+                    await queue.put(("message", {"message": ai_response, "answer_source": "llm"}))
+                    return
+                
+                shared = self.shared_answer_stream(context, cache_key)
+                async for part in shared.subscribe():
+                    emitted = True
+                    await queue.put(("token", {"content": part}))
+                await queue.put(("message", {"message": await shared.result(), "answer_source": "llm"}))
+            except Exception as e:
+                if emitted:
+                    # Đã gửi một phần câu trả lời, không ghép thêm câu dự phòng
+                    await queue.put(("message", {"error": f"Có lỗi xảy ra khi xử lý yêu cầu: {str(e)}"}))
+                    return
+                if is_llm_config_error(e):
+                    print(f"❌ Lỗi cấu hình OpenAI: {e}")
+                    await queue.put(("message", {
+                        "error": ANSWER_TEMPLATES[context["locale"]]["config"], "answer_source": "config_error"
+                    }))
+                    return
+                print(f"⚠️ Dùng câu trả lời dự phòng: {e}")
+                metrics.inc("apartment_llm_fallbacks_total", endpoint="chat_stream")
+                ai_response = self.fallback_answer(context)
+                await queue.put(("token", {"content": ai_response}))
+                await queue.put(("message", {"message": ai_response, "answer_source": "fallback"}))
+        
+        tasks = [asyncio.create_task(produce_images()), asyncio.create_task(produce_tokens())]
+        pending = len(tasks)
+        message = None
+        try:
+            while pending:
+                event, data = await queue.get()
+                if event == "message":
+                    pending -= 1
+                    message = data
+                    continue
+                if event == "images":
+                    pending -= 1
+                yield sse_event(event, data)
+        finally:
+            for task in tasks:
+                task.cancel()
+        
+        if "error" in message:
+            yield sse_event("error", {"success": False, "message": message.pop("error"), **message})
+        else:
+            yield sse_event("done", {"success": True, **message})
 
 @app.post("/chat")
 async def chat_endpoint(request: Dict):
@@ -547,7 +3414,176 @@ async def chat_endpoint(request: Dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(request: Dict):
+    """
+    🤖 Chat dạng streaming (server-sent events)
+    
+    Trả về ngay thông tin căn hộ, sau đó là URL ảnh và từng token câu trả lời
+    của AI khi có. Body giống /chat.
+    """
+    user_query = request.get("query", "").strip()
+    
+    if not user_query:
+        raise HTTPException(status_code=400, detail="Query không được để trống")
+    
+    searcher = get_searcher()
+    chat_agent = ChatAgent(searcher)
+    
+    return StreamingResponse(
+        chat_agent.stream_query(user_query),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+def collect_cache_metrics() -> List[Tuple[str, Dict, float]]:
+    """Metric lấy từ stats() của các cache / render executor tại thời điểm scrape"""
+    caches = {"upload": upload_cache.stats(), "answer": answer_cache.stats()}
+    if searcher is not None:
+        # Không ép load data chỉ để scrape metric
+        caches["render"] = searcher.render_cache.stats()
+    values = []
+    for cache, stats in caches.items():
+        values.append(("apartment_cache_hits_total", {"cache": cache}, stats["hits"]))
+        values.append(("apartment_cache_misses_total", {"cache": cache}, stats["misses"]))
+        values.append(("apartment_cache_hit_ratio", {"cache": cache}, stats["hit_ratio"]))
+        if "entries" in stats:
+            values.append(("apartment_cache_entries", {"cache": cache}, stats["entries"]))
+    values.append(("apartment_upload_queue_depth", {}, upload_queue.stats()["queued"]))
+    values.append(("apartment_llm_circuit_state", {}, LLMGate.STATE_VALUES[llm_gate.state]))
+    executor_stats = render_executor.stats()
+    values.append(("apartment_render_executor_in_flight", {"kind": executor_stats["kind"]}, executor_stats["in_flight"]))
+    values.append(("apartment_render_executor_rejected_total", {"kind": executor_stats["kind"]}, executor_stats["rejected"]))
+    return values
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics_endpoint():
+    """
+    📈 Metric theo Prometheus text format
+
+    Gồm histogram thời gian từng stage (filter, coords, render, encode, upload,
+    llm...), latency theo route, tỉ lệ cache hit, số lỗi upload / LLM và số tác
+    vụ đang chạy. Với RENDER_EXECUTOR=process, thời gian stage render được gửi
+    về process cha nhưng hit/miss render cache của process con không có ở đây.
+    """
+    return PlainTextResponse(
+        metrics.render(collect_cache_metrics()),
+        media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+# Warm-up: mỗi spec là "zoom" hoặc "zoom:max_dim"; mặc định gồm zoom của /search và /chat
+DEFAULT_WARMUP_SPECS = f"100,{CHAT_ZOOM_SIZE}:{CHAT_MAX_IMAGE_DIM or ''}".rstrip(":")
+
+def parse_warmup_specs(specs: str) -> List[Tuple[int, Optional[int]]]:
+    """Parse "100,2000:1024" -> [(100, None), (2000, 1024)]"""
+    result = []
+    for spec in specs.split(","):
+        spec = spec.strip()
+        if not spec:
+            continue
+        zoom_size, _, max_dim = spec.partition(":")
+        result.append((int(zoom_size), int(max_dim) if max_dim else None))
+    return result
+
+def warm_up(searcher: ApartmentSearcher, specs: List[Tuple[int, Optional[int]]], upload: bool = False,
+            workers: Optional[int] = None, progress: bool = True,
+            loop: Optional[asyncio.AbstractEventLoop] = None) -> Dict:
+    """
+    Pre-render + encode (và tùy chọn upload) tất cả căn hộ vào render cache
+    
+    Args:
+        searcher: ApartmentSearcher đã load data
+        specs: Danh sách (zoom_size, max_output_dim)
+        upload: Upload lên Cloudinary để điền sẵn upload cache
+        workers: Số thread render song song (mặc định = số CPU)
+        progress: In tiến độ ra stdout
+        loop: Event loop của app để chạy upload (qua upload_images: retry, single-flight,
+            connection pool chung); None = tạo event loop riêng (CLI)
+    
+    Với RENDER_EXECUTOR=process, render cache của process này không được worker
+    đọc: chỉ render khi cần upload, không thì bỏ qua.
+    
+    Returns:
+        Dict thống kê (số job, lỗi, thời gian, trạng thái render cache)
+    """
+    if render_executor.kind == "process":
+        if not upload:
+            print("⚠️ RENDER_EXECUTOR=process: render cache nằm trong từng process con, bỏ qua warm-up render")
+            return {"jobs": 0, "failed": 0, "seconds": 0.0, "render_cache": searcher.render_cache.stats()}
+        print("⚠️ RENDER_EXECUTOR=process: warm-up chỉ điền upload cache, render cache của process con không được warm")
+    
+    jobs = [(apartment_id, zoom_size, max_dim)
+            for apartment_id in searcher.coord_catalog.ids
+            for zoom_size, max_dim in specs]
+    total = len(jobs)
+    done = 0
+    failed = 0
+    started_at = time.perf_counter()
+    
+    upload_loop = loop
+    if upload and upload_loop is None:
+        # CLI: event loop riêng chạy trong thread nền cho các upload async
+        upload_loop = asyncio.new_event_loop()
+        threading.Thread(target=upload_loop.run_forever, name="warmup-upload", daemon=True).start()
+    
+    def run(job):
+        apartment_id, zoom_size, max_dim = job
+        result = searcher.search_apartment(apartment_id, zoom_size, max_dim)
+        if upload:
+            asyncio.run_coroutine_threadsafe(
+                upload_images(result["encoded"], apartment_id, zoom_size, result["pyramid_levels"]), upload_loop
+            ).result()
+    
+    if progress:
+        print(f"🔥 Warm-up {total} job ({len(searcher.coord_catalog)} căn x {len(specs)} zoom)"
+              f"{' + upload' if upload else ''}...")
+    
+    step = max(1, total // 10)
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1, thread_name_prefix="warmup") as pool:
+        for future in [pool.submit(run, job) for job in jobs]:
+            try:
+                future.result()
+            except Exception as e:
+                failed += 1
+                print(f"❌ Warm-up lỗi: {e}")
+            done += 1
+            if progress and (done % step == 0 or done == total):
+                print(f"   ⏳ {done}/{total} ({done * 100 // total}%) - {time.perf_counter() - started_at:.1f}s")
+    if upload_loop is not None and upload_loop is not loop:
+        asyncio.run_coroutine_threadsafe(close_http_client(), upload_loop).result()
+        upload_loop.call_soon_threadsafe(upload_loop.stop)
+    
+    cache_stats = searcher.render_cache.stats()
+    if cache_stats["evictions"]:
+        print(f"⚠️ Render cache đã evict {cache_stats['evictions']} entry, "
+              f"cân nhắc tăng RENDER_CACHE_MAX_BYTES")
+    stats = {
+        "jobs": total,
+        "failed": failed,
+        "seconds": time.perf_counter() - started_at,
+        "render_cache": cache_stats
+    }
+    if progress:
+        print(f"✅ Warm-up xong: {total - failed}/{total} job trong {stats['seconds']:.1f}s, "
+              f"cache {cache_stats['entries']} entry / {cache_stats['bytes'] / 1024 / 1024:.1f} MB")
+    return stats
+
+def run_cli(argv: List[str]):
+    """CLI: `python main.py warmup ...`"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="main.py warmup", description="Pre-render ảnh tất cả căn hộ")
+    parser.add_argument("--zoom-sizes", default=os.getenv("WARMUP_ZOOM_SIZES", DEFAULT_WARMUP_SPECS),
+                        help='Danh sách "zoom" hoặc "zoom:max_dim", cách nhau bởi dấu phẩy')
+    parser.add_argument("--upload", action="store_true", help="Upload lên Cloudinary (điền upload cache)")
+    parser.add_argument("--workers", type=int, default=None, help="Số thread render song song")
+    args = parser.parse_args(argv)
+    warm_up(get_searcher(), parse_warmup_specs(args.zoom_sizes), upload=args.upload, workers=args.workers)
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "warmup":
+        run_cli(sys.argv[2:])
+        sys.exit(0)
+    
     import uvicorn
     print("🚀 Starting Apartment Search API...")
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
@@ -0,0 +1,25 @@
+"""Fixture dùng chung: bản sao data/ và images/ trong thư mục tạm"""
+import os
+import shutil
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def write_image(path: str, value: int, mtime_offset: float = 0):
+    cv2.imwrite(path, np.full((4000, 5000, 3), value, dtype=np.uint8))
+    if mtime_offset:
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + int(mtime_offset * 1e9)))
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    shutil.copytree(os.path.join(ROOT, "data"), tmp_path / "data")
+    os.makedirs(tmp_path / "images")
+    shutil.copy(os.path.join(ROOT, "images", "blueprint.jpg"), tmp_path / "images" / "blueprint.jpg")
+    write_image(str(tmp_path / "images" / "map.jpg"), 40)
+    return str(tmp_path)
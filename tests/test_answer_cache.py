@@ -0,0 +1,13 @@
+"""Cache câu trả lời vẫn chạy trong bộ nhớ khi file SQLite không mở được"""
+import main
+
+
+def test_unwritable_path_keeps_memory_tier(tmp_path):
+    # Thư mục cha là một file thường nên không tạo được file SQLite
+    (tmp_path / "not_a_dir").write_text("")
+    cache = main.AnswerCache(str(tmp_path / "not_a_dir" / "answers.sqlite3"))
+    assert cache.get("key", "v1") is None
+    cache.put("key", "v1", "câu trả lời")
+    assert cache.get("key", "v1") == "câu trả lời"
+    assert cache.purge_stale("v2") == 0
+    assert cache.get("key", "v2") is None
@@ -0,0 +1,35 @@
+"""Luồng SSE của /chat/stream luôn kết thúc, kể cả khi cache câu trả lời lỗi"""
+import asyncio
+import json
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def agent(data_dir, monkeypatch):
+    agent = main.ChatAgent(main.ApartmentSearcher(data_dir=data_dir))
+
+    async def no_images(context):
+        return {"images_urls": {}}
+
+    monkeypatch.setattr(agent, "fetch_all_images_urls", no_images)
+    return agent
+
+
+def collect(agent, query):
+    async def run():
+        return [chunk async for chunk in agent.stream_query(query)]
+    return asyncio.run(asyncio.wait_for(run(), timeout=10))
+
+
+def test_cache_lookup_error_ends_stream(agent, monkeypatch):
+    def broken_get(key, sheet_version):
+        raise RuntimeError("cache hỏng")
+
+    monkeypatch.setattr(main.answer_cache, "get", broken_get)
+    chunks = collect(agent, "Căn số 17 tầng 2 Origami có rộng không?")
+    last = chunks[-1]
+    assert last.startswith("event: error")
+    assert "cache hỏng" in json.loads(last.split("data: ", 1)[1])["message"]
@@ -0,0 +1,42 @@
+"""Fast path trả lời bằng template của ChatAgent (không gọi OpenAI)"""
+import pytest
+
+import main
+
+
+@pytest.fixture
+def agent(data_dir):
+    return main.ChatAgent(main.ApartmentSearcher(data_dir=data_dir))
+
+
+def answer(agent, query):
+    return agent.template_answer(query, agent.build_context(query))
+
+
+def test_requested_fields_only(agent):
+    text = answer(agent, "Căn hộ số 17, tầng 2, Origami hiện có loại hình và giá bao nhiêu?")
+    assert "loại hình" in text and "tổng giá" in text
+    assert "diện tích" not in text
+
+
+def test_full_details_ignore_filter_terms(agent):
+    # "căn góc" / "2PN" là điều kiện lọc, không phải trường được hỏi
+    for query in ("Thông tin đầy đủ của căn góc số 26, tầng 2, Origami là gì?",
+                  "thông tin chi tiết căn số 17 tầng 2 loại 2PN"):
+        text = answer(agent, query)
+        assert all(part in text for part in ("loại hình", "diện tích", "tổng giá", "căn góc")), text
+
+
+def test_filter_terms_alone_are_not_a_question(agent):
+    assert answer(agent, "căn góc số 26 tầng 2 Origami") is None
+
+
+def test_evaluative_questions_use_llm(agent):
+    for query in ("Căn số 17 tầng 2 Origami có rộng không?",
+                  "Căn số 17 tầng 2 Origami giá vậy có đáng mua?"):
+        assert answer(agent, query) is None
+
+
+def test_english_locale(agent):
+    text = answer(agent, "What is the price of apartment 17 on floor 2 Origami?")
+    assert text.startswith("Apartment") and "billion VND" in text
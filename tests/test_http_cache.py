@@ -0,0 +1,37 @@
+"""ETag / 304: chỉ trả 304 cho tài nguyên tồn tại (response sẽ là 200)"""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+ANY = {"If-None-Match": "*"}
+
+
+@pytest.fixture
+def client(data_dir, monkeypatch):
+    monkeypatch.setattr(main, "searcher", main.ApartmentSearcher(data_dir=data_dir))
+    return TestClient(main.app)
+
+
+def test_search_wildcard(client):
+    assert client.get("/search", params={"apartment": "CH99"}, headers=ANY).status_code == 404
+    response = client.get("/search", params={"apartment": "CH01", "format": "images"}, headers=ANY)
+    assert response.status_code == 304
+    assert response.headers["ETag"]
+
+
+def test_search_etag_round_trip(client):
+    params = {"apartment": "CH01", "format": "images"}
+    etag = client.get("/search", params=params).headers["ETag"]
+    assert client.get("/search", params=params, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/search", params={**params, "apartment": "CH99"},
+                      headers={"If-None-Match": etag}).status_code == 404
+
+
+def test_locate_wildcard_outside_radius(client):
+    params = {"layer": "map", "x": -100000, "y": -100000, "radius": 10}
+    assert client.get("/locate", params=params, headers=ANY).status_code == 404
+
+
+def test_missing_stored_image_wildcard(client):
+    assert client.get("/images/" + "0" * 64 + ".jpg", headers=ANY).status_code == 404
@@ -0,0 +1,86 @@
+"""Deadline và circuit breaker của lời gọi OpenAI"""
+import asyncio
+import json
+import socket
+import threading
+import time
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def agent(data_dir, monkeypatch):
+    monkeypatch.setattr(main, "async_client", None)
+    monkeypatch.setattr(main, "llm_gate", main.LLMGate(1, 1, 10, 20, 1, 0.5, 30))
+    return main.ChatAgent(main.ApartmentSearcher(data_dir=data_dir))
+
+
+@pytest.fixture
+def hung_server():
+    """Server nhận kết nối nhưng không bao giờ trả lời; trả về (base_url, danh sách kết nối)"""
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen()
+    connections = []
+
+    def accept():
+        while True:
+            try:
+                connections.append(server.accept()[0])
+            except OSError:
+                return
+
+    threading.Thread(target=accept, daemon=True).start()
+    yield f"http://127.0.0.1:{server.getsockname()[1]}/v1", connections
+    server.close()
+    for connection in connections:
+        connection.close()
+
+
+def test_deadline_covers_whole_call(agent, hung_server, monkeypatch):
+    base_url, connections = hung_server
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setenv("OPENAI_BASE_URL", base_url)
+    monkeypatch.setattr(main, "LLM_TIMEOUT", 0.5)
+    context = agent.build_context("căn góc tầng 2 Origami")
+
+    started_at = time.perf_counter()
+    with pytest.raises(TimeoutError):
+        asyncio.run(agent.complete_answer(context, "key"))
+    assert time.perf_counter() - started_at < 1.5
+    assert len(connections) == 1
+    # Timeout là lỗi của OpenAI -> breaker (min_calls=1) mở
+    assert main.llm_gate.state == main.LLMGate.OPEN
+
+
+def test_missing_api_key_is_not_a_breaker_failure(agent, monkeypatch):
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    context = agent.build_context("căn góc tầng 2 Origami")
+    with pytest.raises(main.LLMConfigError):
+        asyncio.run(agent.complete_answer(context, "key"))
+    assert main.llm_gate.state == main.LLMGate.CLOSED
+    assert main.llm_gate.stats()["window_calls"] == 0
+
+
+def test_missing_api_key_is_a_config_error(agent, tmp_path, monkeypatch):
+    async def no_images(context):
+        return {"images_urls": {}}
+
+    async def stream(query):
+        return [chunk async for chunk in agent.stream_query(query)]
+
+    monkeypatch.delenv("OPENAI_API_KEY", raising=False)
+    monkeypatch.setattr(main, "answer_cache", main.AnswerCache(str(tmp_path / "answers.sqlite3")))
+    monkeypatch.setattr(agent, "fetch_all_images_urls", no_images)
+    query = "Căn số 17 tầng 2 Origami có rộng không?"
+
+    result = asyncio.run(agent.process_query(query))
+    assert not result["success"] and result["answer_source"] == "config_error"
+    assert result["message"] == main.ANSWER_TEMPLATES["vi"]["config"]
+
+    last = asyncio.run(stream(query))[-1]
+    assert last.startswith("event: error")
+    data = json.loads(last.split("data: ", 1)[1])
+    assert not data["success"] and data["answer_source"] == "config_error"
@@ -0,0 +1,44 @@
+"""Hot reload của ApartmentSearcher (data/ và images/ trong thư mục tạm)"""
+import os
+
+import main
+from conftest import write_image
+
+
+def test_image_change_serves_new_pyramid(data_dir):
+    searcher = main.ApartmentSearcher(data_dir=data_dir)
+    blueprint_pyramid = searcher.image_pyramids["blueprint"]
+    old_digest = searcher.image_digests["map"]
+    before = searcher.search_apartment("CH01", 400)
+    assert abs(int(before["images"]["map"][0, 0, 0]) - 40) <= 2
+
+    write_image(os.path.join(data_dir, "images", "map.jpg"), 200, mtime_offset=1)
+    assert searcher.check_for_updates() == {"map_image"}
+
+    assert searcher.image_digests["map"] != old_digest
+    assert abs(int(searcher.image_pyramids["map"][0][0, 0, 0]) - 200) <= 2
+    # Layer không đổi giữ nguyên pyramid cũ
+    assert searcher.image_pyramids["blueprint"] is blueprint_pyramid
+    after = searcher.search_apartment("CH01", 400)
+    assert abs(int(after["images"]["map"][0, 0, 0]) - 200) <= 2
+
+    # Fingerprint đã được cập nhật: lần kiểm tra sau không reload lại
+    assert searcher.check_for_updates() == set()
+
+
+def test_sheet_change_drops_stale_answers(data_dir, tmp_path, monkeypatch):
+    cache = main.AnswerCache(str(tmp_path / "answers.sqlite3"))
+    monkeypatch.setattr(main, "answer_cache", cache)
+    searcher = main.ApartmentSearcher(data_dir=data_dir)
+    old_version = searcher.sheet_version
+    cache.put("key", old_version, "câu trả lời cũ")
+    assert cache.get("key", old_version) == "câu trả lời cũ"
+
+    sheet_path = os.path.join(data_dir, "data", "sheet.csv")
+    with open(sheet_path, "a", encoding="utf-8") as f:
+        f.write("\n")
+    assert searcher.check_for_updates() == {"sheet_csv"}
+
+    assert searcher.sheet_version != old_version
+    assert cache.get("key", searcher.sheet_version) is None
+    assert cache._connection().execute("SELECT COUNT(*) FROM answers").fetchone()[0] == 0
@@ -0,0 +1,32 @@
+"""Render ảnh zoom / tổng quan từ image pyramid"""
+import pytest
+
+import main
+
+
+@pytest.fixture
+def searcher(data_dir):
+    return main.ApartmentSearcher(data_dir=data_dir)
+
+
+@pytest.mark.parametrize("max_dim", [64, 100])
+def test_max_dim_beyond_coarsest_level(searcher, max_dim):
+    # 3000 >> 3 = 375 > max_dim nhưng pyramid chỉ có 4 tầng
+    result = searcher.search_apartment("CH01", 3000, max_dim)
+    for image_type, image in result["images"].items():
+        assert result["pyramid_levels"][image_type] == len(searcher.image_pyramids[image_type]) - 1
+        assert max(image.shape[:2]) == max_dim
+
+
+def test_max_dim_overview(searcher):
+    result = searcher.search_apartments_overview(["CH01", "CH02", "CH03"], 32)
+    assert all(max(image.shape[:2]) <= 32 for image in result["images"].values())
+
+
+def test_level_follows_swapped_pyramid(searcher):
+    # Reload đổi số tầng pyramid: tầng được chọn theo pyramid đang dùng
+    with searcher._swap_lock:
+        searcher.image_pyramids = {**searcher.image_pyramids, "map": searcher.image_pyramids["map"][:2]}
+    result = searcher.search_apartment("CH01", 3000, 64)
+    assert result["pyramid_levels"]["map"] == 1
+    assert max(result["images"]["map"].shape[:2]) == 64
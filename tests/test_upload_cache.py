@@ -0,0 +1,31 @@
+"""Cache upload chỉ là best-effort: file SQLite không mở được thì coi như miss"""
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+
+@pytest.fixture
+def broken_cache(tmp_path, monkeypatch):
+    # Thư mục cha là một file thường nên không tạo được file SQLite
+    (tmp_path / "not_a_dir").write_text("")
+    cache = main.UploadCache(str(tmp_path / "not_a_dir" / "upload_cache.sqlite3"))
+    monkeypatch.setattr(main, "upload_cache", cache)
+    return cache
+
+
+def test_unwritable_path_is_a_miss(broken_cache):
+    assert broken_cache.get("hash", "public_id") is None
+    broken_cache.put("hash", "public_id", "https://example.com/a.jpg")
+
+
+def test_search_json_without_cache(broken_cache, data_dir, monkeypatch):
+    async def fake_upload(image_bytes, public_id, content_hash, image_format):
+        return f"https://example.com/{public_id}"
+
+    monkeypatch.setattr(main, "searcher", main.ApartmentSearcher(data_dir=data_dir))
+    monkeypatch.setattr(main, "IMAGE_STORAGE", "cloudinary")
+    monkeypatch.setattr(main, "_upload_uncached", fake_upload)
+    response = TestClient(main.app).get("/search", params={"apartment": "CH01", "upload": "sync"})
+    assert response.status_code == 200
+    assert all(url.startswith("https://example.com/") for url in response.json()["data"]["images_urls"].values())